@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Load of many clients against single NATadm server, on loopback.
+
+For each number of clients, every simulated client (with its own name)
+polls the server once, all at the same time, just as client/NATadm.py does
+when nobody waits for its tunnel. Then the same number of clients keeps
+control channels open, to see memory cost of a connected client. Server
+statistics are read from /proc, so this works on Linux only.
+"""
+
+import json
+import os.path
+import platform
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from utils import root_dir, free_port, make_certificates, write_config, percentiles, git_revision
+
+import tornado.gen
+import tornado.ioloop
+import tornado.options
+import tornado.tcpclient
+
+import common.protocol
+import common.utils
+
+tornado.options.define('clients', type=int, multiple=True, default=[100, 1000, 10000], help='numbers of simulated clients, run one after another')
+tornado.options.define('concurrency', type=int, default=0, help='clients polling at the same time (default: all)')
+tornado.options.define('protocol_version', type=int, default=common.protocol.MAX_VERSION, help='version sent in hello')
+tornado.options.define('workers', type=int, default=1, help='passed to server')
+tornado.options.define('timeout', type=int, default=60, help='seconds for single handshake')
+tornado.options.define('log_level', type=str, default='warning', help='logging of server')
+tornado.options.define('output', type=str, default=None, help='file for JSON results (default: stdout)')
+tornado.options.define('keep', type=bool, default=False, help='keep temporary directory (certificates, config, log)')
+
+def stat_fields(pid):
+	with open('/proc/{}/stat'.format(pid)) as f:
+		return f.read().rsplit(')', 1)[1].split()
+
+class ProcessStats:
+	"""CPU time and memory of process group (server with its workers), from /proc"""
+	def __init__(self, pid):
+		self.pid = pid
+
+	def pids(self):
+		for name in os.listdir('/proc'):
+			try:
+				# process group is 5th field of the whole line
+				if name.isdigit() and int(stat_fields(name)[2]) == self.pid:
+					yield name
+			except OSError:
+				pass
+
+	def cpu_seconds(self):
+		total = 0
+		for pid in self.pids():
+			fields = stat_fields(pid)
+			# utime and stime are 14th and 15th fields of the whole line
+			total += int(fields[11]) + int(fields[12])
+		return total / os.sysconf('SC_CLK_TCK')
+
+	def rss_bytes(self):
+		total = 0
+		for pid in self.pids():
+			with open('/proc/{}/status'.format(pid)) as f:
+				for line in f:
+					if line.startswith('VmRSS:'):
+						total += int(line.split()[1])*1024
+		return total
+
+def generator_cpu_seconds():
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	return usage.ru_utime + usage.ru_stime
+
+def listen_drops():
+	"""System wide counters of connections dropped by full accept queues"""
+	with open('/proc/net/netstat') as f:
+		lines = f.read().splitlines()
+	for (header, values) in zip(lines[::2], lines[1::2]):
+		if header.startswith('TcpExt:'):
+			counters = dict(zip(header.split()[1:], map(int, values.split()[1:])))
+			return {name: counters.get(name, 0) for name in ('ListenOverflows', 'ListenDrops')}
+	return {}
+
+class LoadGenerator:
+	def __init__(self, port, ssl_options, protocol_version, timeout):
+		self.port = port
+		self.ssl_options = ssl_options
+		self.protocol_version = protocol_version
+		self.timeout = timeout
+		self.io_loop = tornado.ioloop.IOLoop.instance()
+
+	@tornado.gen.coroutine
+	def handshake(self, name, mode):
+		stream = yield tornado.tcpclient.TCPClient().connect('127.0.0.1', self.port, ssl_options=self.ssl_options)
+		yield common.protocol.hello(name, self.protocol_version, mode).write(stream)
+		if self.protocol_version >= common.protocol.BINARY_VERSION:
+			common.protocol.use_binary_format(stream)
+		package = yield common.protocol.package.read(stream)
+		return (stream, package)
+
+	@tornado.gen.coroutine
+	def poll(self, name):
+		start = time.perf_counter()
+		(stream, package) = yield tornado.gen.with_timeout(self.io_loop.time() + self.timeout, self.handshake(name, common.protocol.MODE_POLL))
+		stream.close()
+		if not isinstance(package, common.protocol.not_interested):
+			raise Exception('Unexpected package: {}'.format(package))
+		return time.perf_counter() - start
+
+	@tornado.gen.coroutine
+	def checked(self, future):
+		try:
+			return (yield future)
+		except Exception as e:
+			return e
+
+	@tornado.gen.coroutine
+	def poll_all(self, count, concurrency):
+		names = iter(range(count))
+		results = []
+		@tornado.gen.coroutine
+		def worker():
+			for i in names:
+				results.append((yield self.checked(self.poll('client-{}'.format(i)))))
+		yield [worker() for i in range(concurrency or count)]
+		return results
+
+	@tornado.gen.coroutine
+	def connect_all(self, count):
+		futures = [self.checked(tornado.gen.with_timeout(self.io_loop.time() + self.timeout, self.handshake('client-{}'.format(i), common.protocol.MODE_CONTROL))) for i in range(count)]
+		results = yield futures
+		return [result[0] for result in results if not isinstance(result, Exception)]
+
+def errors_summary(results):
+	errors = dict()
+	for result in results:
+		if isinstance(result, Exception):
+			name = type(result).__name__
+			errors[name] = errors.get(name, 0) + 1
+	return errors
+
+@tornado.gen.coroutine
+def measure(generator, server, count, concurrency):
+	result = {'clients': count}
+
+	drops_before = listen_drops()
+	cpu_before = server.cpu_seconds()
+	generator_cpu_before = generator_cpu_seconds()
+	start = time.perf_counter()
+	results = yield generator.poll_all(count, concurrency)
+	seconds = time.perf_counter() - start
+	cpu = server.cpu_seconds() - cpu_before
+	generator_cpu = generator_cpu_seconds() - generator_cpu_before
+	drops_after = listen_drops()
+
+	times = [r for r in results if not isinstance(r, Exception)]
+	result['poll'] = {
+		'seconds': round(seconds, 3),
+		'handshakes': len(times),
+		'handshakes_per_s': round(len(times)/seconds, 1),
+		'server_cpu_seconds': round(cpu, 3),
+		'server_cpu_ms_per_handshake': round(cpu*1000/len(times), 3) if times else None,
+		# if close to seconds, load generator itself is the bottleneck
+		'generator_cpu_seconds': round(generator_cpu, 3),
+		'errors': errors_summary(results),
+		'listen_drops': {name: drops_after[name] - drops_before.get(name, 0) for name in drops_after},
+	}
+	if times:
+		result['poll']['handshake'] = percentiles(times)
+
+	rss_before = server.rss_bytes()
+	streams = yield generator.connect_all(count)
+	# let server finish registering channels
+	yield tornado.gen.Task(generator.io_loop.add_timeout, generator.io_loop.time() + 1)
+	rss = server.rss_bytes() - rss_before
+	result['connected'] = {
+		'clients': len(streams),
+		'server_rss_bytes': server.rss_bytes(),
+		'server_rss_bytes_per_client': round(rss/len(streams)) if streams else None,
+	}
+	for stream in streams:
+		stream.close()
+	yield tornado.gen.Task(generator.io_loop.add_timeout, generator.io_loop.time() + 1)
+	return result
+
+@tornado.gen.coroutine
+def run(generator, server):
+	options = tornado.options.options
+	deadline = time.time() + 30
+	while True:
+		try:
+			yield generator.poll('warmup')
+			break
+		except Exception:
+			if time.time() > deadline:
+				raise
+			yield tornado.gen.Task(generator.io_loop.add_timeout, generator.io_loop.time() + 0.2)
+	results = []
+	for count in options.clients:
+		results.append((yield measure(generator, server, count, options.concurrency)))
+	return results
+
+def main():
+	tornado.options.parse_command_line()
+	options = tornado.options.options
+
+	# each simulated client needs a descriptor, both here and in server
+	(soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+	directory = tempfile.mkdtemp(prefix='NATadm-benchmark-')
+	process = None
+	try:
+		make_certificates(directory)
+		port = free_port()
+		write_config(os.path.join(directory, 'server.conf'), {
+			'logging': options.log_level,
+			'communication_port': port,
+			'communication_server_certificate': (os.path.join(directory, 'server.crt.pem'), os.path.join(directory, 'server.key.pem')),
+			'communication_client_ca': os.path.join(directory, 'ca.pem'),
+			'services': {},
+			'workers': options.workers,
+		})
+		with open(os.path.join(directory, 'server.log'), 'w') as log:
+			process = subprocess.Popen(
+				[sys.executable, os.path.join(root_dir, 'server/NATadm_server.py'), '--config_file='+os.path.join(directory, 'server.conf')],
+				stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+			)
+
+		generator = LoadGenerator(port, common.utils.ssl_options(
+			certfile=os.path.join(directory, 'client.crt.pem'),
+			keyfile=os.path.join(directory, 'client.key.pem'),
+			cacerts=os.path.join(directory, 'ca.pem')
+		), options.protocol_version, options.timeout)
+		server = ProcessStats(process.pid)
+		results = tornado.ioloop.IOLoop.instance().run_sync(lambda: run(generator, server))
+
+		report = {
+			'revision': git_revision(),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'file_descriptors_limit': hard,
+			'options': {name: getattr(options, name) for name in ('clients', 'concurrency', 'protocol_version', 'workers', 'timeout', 'log_level')},
+			'results': results,
+		}
+		output = json.dumps(report, indent=2, sort_keys=True)
+		if options.output:
+			with open(options.output, 'w') as f:
+				f.write(output + '\n')
+		else:
+			print(output)
+	finally:
+		if process is not None:
+			# with workers, whole group of processes
+			os.killpg(process.pid, signal.SIGKILL)
+			process.wait()
+		if options.keep:
+			print('Temporary files kept in {}'.format(directory), file=sys.stderr)
+		else:
+			shutil.rmtree(directory)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark of the whole tunnel path, on loopback.
+
+Starts NATadm server and client as subprocesses, with throwaway
+certificates, and local echo, sink and source services behind the client.
+Connects to the server as a user would and prints results as JSON.
+"""
+
+import json
+import os.path
+import platform
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from utils import root_dir, free_port, make_certificates, write_config, percentiles, git_revision
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.options
+import tornado.tcpclient
+import tornado.tcpserver
+
+tornado.options.define('upload_size', type=int, default=64*1024*1024, help='bytes sent by user to sink service')
+tornado.options.define('download_size', type=int, default=64*1024*1024, help='bytes sent by source service to user')
+tornado.options.define('chunk_size', type=int, default=64*1024, help='size of single write in upload')
+tornado.options.define('frame_size', type=int, default=128, help='size of small writes, counted as frames')
+tornado.options.define('frame_count', type=int, default=100000)
+tornado.options.define('latency_size', type=int, default=64, help='size of echoed message in round trip test')
+tornado.options.define('latency_count', type=int, default=2000)
+tornado.options.define('setup_count', type=int, default=100)
+tornado.options.define('control_channel', type=bool, default=True, help='passed to client')
+tornado.options.define('plaintext', type=bool, default=False, help='connections of client with server without TLS')
+tornado.options.define('splice', type=bool, default=False, help='passed to server (implies --plaintext)')
+tornado.options.define('log_level', type=str, default='warning', help='logging of server and client')
+tornado.options.define('output', type=str, default=None, help='file for JSON results (default: stdout)')
+tornado.options.define('keep', type=bool, default=False, help='keep temporary directory (certificates, configs, logs)')
+
+SIZE = struct.Struct('!Q')
+
+# Window of unflushed bytes used by generators of traffic
+WRITE_WINDOW = 4*1024*1024
+
+CLIENT_NAME = 'benchmark'
+
+class EchoService(tornado.tcpserver.TCPServer):
+	@tornado.gen.coroutine
+	def handle_stream(self, stream, address):
+		stream.set_nodelay(True)
+		try:
+			while True:
+				data = yield stream.read_bytes(65536, partial=True)
+				yield stream.write(data)
+		except tornado.iostream.StreamClosedError:
+			pass
+
+class SinkService(tornado.tcpserver.TCPServer):
+	"""Reads size, then that many bytes; answers with the same size"""
+	@tornado.gen.coroutine
+	def handle_stream(self, stream, address):
+		try:
+			header = yield stream.read_bytes(SIZE.size)
+			(size,) = SIZE.unpack(header)
+			while size:
+				data = yield stream.read_bytes(min(size, 1024*1024), partial=True)
+				size -= len(data)
+			yield stream.write(header)
+		except tornado.iostream.StreamClosedError:
+			pass
+
+class SourceService(tornado.tcpserver.TCPServer):
+	"""Reads size, then sends that many bytes"""
+	@tornado.gen.coroutine
+	def handle_stream(self, stream, address):
+		try:
+			(size,) = SIZE.unpack((yield stream.read_bytes(SIZE.size)))
+			chunk = os.urandom(tornado.options.options.chunk_size)
+			while size:
+				future = stream.write(chunk[:size])
+				size -= min(size, len(chunk))
+				if stream.write_buffer_size() > WRITE_WINDOW:
+					yield future
+			yield stream.read_until_close()
+		except tornado.iostream.StreamClosedError:
+			pass
+
+@tornado.gen.coroutine
+def connect(port):
+	stream = yield tornado.tcpclient.TCPClient().connect('127.0.0.1', port)
+	stream.set_nodelay(True)
+	return stream
+
+@tornado.gen.coroutine
+def wait_for_tunnel(port, timeout):
+	deadline = time.time() + timeout
+	while True:
+		try:
+			stream = yield connect(port)
+			yield stream.write(b'x')
+			yield tornado.gen.with_timeout(tornado.ioloop.IOLoop.instance().time() + 5, stream.read_bytes(1))
+			stream.close()
+			return
+		except Exception:
+			if time.time() > deadline:
+				raise Exception('Tunnel did not come up in {} s'.format(timeout))
+			io_loop = tornado.ioloop.IOLoop.instance()
+			yield tornado.gen.Task(io_loop.add_timeout, io_loop.time() + 0.2)
+
+@tornado.gen.coroutine
+def measure_setup(port, count):
+	"""Time from connecting to server until first byte is echoed by service"""
+	samples = []
+	for i in range(count):
+		start = time.perf_counter()
+		stream = yield connect(port)
+		yield stream.write(b'x')
+		yield stream.read_bytes(1)
+		samples.append(time.perf_counter() - start)
+		stream.close()
+	return percentiles(samples)
+
+@tornado.gen.coroutine
+def measure_latency(port, count, size):
+	stream = yield connect(port)
+	message = os.urandom(size)
+	samples = []
+	for i in range(count):
+		start = time.perf_counter()
+		yield stream.write(message)
+		yield stream.read_bytes(size)
+		samples.append(time.perf_counter() - start)
+	stream.close()
+	result = percentiles(samples)
+	result['size'] = size
+	return result
+
+@tornado.gen.coroutine
+def send(port, size, chunk_size):
+	"""Sends size bytes to sink in writes of chunk_size; returns seconds"""
+	stream = yield connect(port)
+	chunk = os.urandom(chunk_size)
+	start = time.perf_counter()
+	yield stream.write(SIZE.pack(size))
+	remaining = size
+	while remaining:
+		future = stream.write(chunk[:remaining])
+		remaining -= min(remaining, chunk_size)
+		if stream.write_buffer_size() > WRITE_WINDOW:
+			yield future
+	yield stream.read_bytes(SIZE.size)
+	seconds = time.perf_counter() - start
+	stream.close()
+	return seconds
+
+@tornado.gen.coroutine
+def measure_upload(port, size, chunk_size):
+	seconds = yield send(port, size, chunk_size)
+	return {'bytes': size, 'chunk_size': chunk_size, 'seconds': round(seconds, 3), 'mb_per_s': round(size/seconds/1e6, 2)}
+
+@tornado.gen.coroutine
+def measure_frames(port, count, frame_size):
+	seconds = yield send(port, count*frame_size, frame_size)
+	return {'count': count, 'size': frame_size, 'seconds': round(seconds, 3), 'frames_per_s': round(count/seconds)}
+
+@tornado.gen.coroutine
+def measure_download(port, size):
+	stream = yield connect(port)
+	start = time.perf_counter()
+	yield stream.write(SIZE.pack(size))
+	remaining = size
+	while remaining:
+		data = yield stream.read_bytes(min(remaining, 1024*1024), partial=True)
+		remaining -= len(data)
+	seconds = time.perf_counter() - start
+	stream.close()
+	return {'bytes': size, 'seconds': round(seconds, 3), 'mb_per_s': round(size/seconds/1e6, 2)}
+
+@tornado.gen.coroutine
+def run(ports):
+	options = tornado.options.options
+	yield wait_for_tunnel(ports['echo'], 60)
+	results = dict()
+	results['setup'] = yield measure_setup(ports['echo'], options.setup_count)
+	results['latency'] = yield measure_latency(ports['echo'], options.latency_count, options.latency_size)
+	results['upload'] = yield measure_upload(ports['sink'], options.upload_size, options.chunk_size)
+	results['frames'] = yield measure_frames(ports['sink'], options.frame_count, options.frame_size)
+	results['download'] = yield measure_download(ports['source'], options.download_size)
+	return results
+
+def main():
+	tornado.options.parse_command_line()
+	options = tornado.options.options
+	directory = tempfile.mkdtemp(prefix='NATadm-benchmark-')
+	processes = []
+	try:
+		make_certificates(directory)
+
+		services = dict()
+		ports = dict()
+		for name, service_class in (('echo', EchoService), ('sink', SinkService), ('source', SourceService)):
+			service = service_class()
+			service_port = free_port()
+			service.listen(service_port, '127.0.0.1')
+			ports[name] = free_port()
+			services[ports[name]] = {'client': CLIENT_NAME, 'port': service_port}
+
+		communication_port = free_port()
+		# kernel relays plaintext connections only
+		plaintext = options.plaintext or options.splice
+		write_config(os.path.join(directory, 'server.conf'), {
+			'logging': options.log_level,
+			'communication_port': communication_port,
+			'communication_server_certificate': (os.path.join(directory, 'server.crt.pem'), os.path.join(directory, 'server.key.pem')),
+			'communication_client_ca': os.path.join(directory, 'ca.pem'),
+			'services': services,
+			'communication_plaintext': plaintext,
+			'splice': options.splice,
+		})
+		write_config(os.path.join(directory, 'client.conf'), {
+			'logging': options.log_level,
+			'name': CLIENT_NAME,
+			'remote': ('127.0.0.1', communication_port),
+			'certificate': (os.path.join(directory, 'client.crt.pem'), os.path.join(directory, 'client.key.pem')),
+			'cafile': os.path.join(directory, 'ca.pem'),
+			'interval': 1,
+			'infinite': True,
+			'control_channel': options.control_channel,
+			'plaintext': plaintext,
+		})
+
+		for (name, script) in (('server', 'server/NATadm_server.py'), ('client', 'client/NATadm.py')):
+			log = open(os.path.join(directory, name+'.log'), 'w')
+			processes.append(subprocess.Popen(
+				[sys.executable, os.path.join(root_dir, script), '--config_file='+os.path.join(directory, name+'.conf')],
+				stdout=log, stderr=subprocess.STDOUT
+			))
+			log.close()
+
+		results = tornado.ioloop.IOLoop.instance().run_sync(lambda: run(ports))
+		report = {
+			'revision': git_revision(),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'options': {name: getattr(options, name) for name in (
+				'upload_size', 'download_size', 'chunk_size', 'frame_size', 'frame_count',
+				'latency_size', 'latency_count', 'setup_count', 'control_channel', 'plaintext', 'splice', 'log_level'
+			)},
+			'results': results,
+		}
+		output = json.dumps(report, indent=2, sort_keys=True)
+		if options.output:
+			with open(options.output, 'w') as f:
+				f.write(output + '\n')
+		else:
+			print(output)
+	finally:
+		for process in processes:
+			process.kill()
+			process.wait()
+		if options.keep:
+			print('Temporary files kept in {}'.format(directory), file=sys.stderr)
+		else:
+			shutil.rmtree(directory)
+
+if __name__ == '__main__':
+	main()
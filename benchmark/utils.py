@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os.path
+import socket
+import subprocess
+import sys
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(current_dir)
+sys.path.insert(0, root_dir)
+
+CA_CONFIG = '''[ca]
+default_ca = benchmark
+[benchmark]
+database = index.txt
+crlnumber = crlnumber
+default_md = sha256
+default_crl_days = 2
+'''
+
+def free_port():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+def openssl(directory, *args):
+	subprocess.check_call(('openssl',) + args, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def make_certificates(directory):
+	"""Self-signed CA, server and client certificates, and empty CRL"""
+	openssl(directory, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', 'ca.key.pem', '-out', 'ca.crt.pem', '-days', '2', '-subj', '/CN=NATadm benchmark CA')
+	for name in ('server', 'client'):
+		openssl(directory, 'req', '-newkey', 'rsa:2048', '-nodes', '-keyout', name+'.key.pem', '-out', name+'.csr', '-subj', '/CN=localhost')
+		openssl(directory, 'x509', '-req', '-in', name+'.csr', '-CA', 'ca.crt.pem', '-CAkey', 'ca.key.pem', '-CAcreateserial', '-out', name+'.crt.pem', '-days', '2')
+	with open(os.path.join(directory, 'ca.conf'), 'w') as f:
+		f.write(CA_CONFIG)
+	open(os.path.join(directory, 'index.txt'), 'w').close()
+	with open(os.path.join(directory, 'crlnumber'), 'w') as f:
+		f.write('01\n')
+	openssl(directory, 'ca', '-config', 'ca.conf', '-gencrl', '-keyfile', 'ca.key.pem', '-cert', 'ca.crt.pem', '-out', 'ca.crl.pem')
+	with open(os.path.join(directory, 'ca.pem'), 'w') as f:
+		for name in ('ca.crt.pem', 'ca.crl.pem'):
+			with open(os.path.join(directory, name)) as g:
+				f.write(g.read())
+
+def write_config(path, options):
+	with open(path, 'w') as f:
+		for key, value in options.items():
+			f.write('{} = {!r}\n'.format(key, value))
+
+def percentiles(samples):
+	samples = sorted(samples)
+	def percentile(p):
+		return round(samples[min(len(samples)-1, int(len(samples)*p))]*1000, 3)
+	return {
+		'count': len(samples),
+		'p50_ms': percentile(0.5),
+		'p99_ms': percentile(0.99),
+		'max_ms': round(samples[-1]*1000, 3),
+	}
+
+def git_revision():
+	try:
+		return subprocess.check_output(('git', 'describe', '--always', '--dirty'), cwd=root_dir, stderr=subprocess.DEVNULL).decode().strip()
+	except Exception:
+		return None
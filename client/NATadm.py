@@ -30,11 +30,14 @@ sys.path.insert(0, os.path.dirname(current_dir))
 
 import tornado.gen
 import tornado.ioloop
+import tornado.iostream
 import tornado.options
 import tornado.tcpclient
 
+import common.metrics
 import common.protocol
 import common.proxy
+import common.splice
 import common.utils
 
 common.utils.reformat_logger('CLIENT')
@@ -45,8 +48,16 @@ tornado.options.define('name', type=str)
 tornado.options.define('remote', type=tuple)
 tornado.options.define('certificate', type=tuple)
 tornado.options.define('cafile', type=str)
+tornado.options.define('plaintext', type=bool, default=False)
 tornado.options.define('interval', type=int, default=60)
 tornado.options.define('infinite', type=bool, default=False)
+tornado.options.define('control_channel', type=bool, default=True)
+tornado.options.define('standby_connections', type=int, default=0)
+tornado.options.define('proxy_write_window', type=int, default=common.proxy.DEFAULT_WRITE_WINDOW)
+tornado.options.define('bulk_budget', type=int, default=common.proxy.DEFAULT_BULK_BUDGET)
+tornado.options.define('metrics_interval', type=int, default=600)
+tornado.options.define('traffic_log_interval', type=int, default=common.proxy.DEFAULT_TRAFFIC_LOG_INTERVAL)
+tornado.options.define('payload_dump_every', type=int, default=common.proxy.DEFAULT_PAYLOAD_DUMP_EVERY)
 
 tornado.options.define('config_file', type=str)
 
@@ -61,16 +72,39 @@ if len(config_file) != 0:
 
 tornado.options.options.run_parse_callbacks()
 
+common.proxy.scheduler.bulk_budget = tornado.options.options.bulk_budget
+common.proxy.payload_dump_every = max(1, tornado.options.options.payload_dump_every)
+
+# newest version accepted by server, used by polls; agreed over control
+# channel, or lowered when server rejects poll with newer one
+server_protocol_version = common.protocol.MAX_VERSION
+
+# context of last connection; it resumes TLS session of previous one, as
+# long as certificates are not changed
+ssl_context = None
+
+# polls started for tunnels reported pending by server, not answered yet
+pending_polls = 0
+
+tls_handshakes = common.metrics.counter('tls_handshakes_total', 'TLS handshakes with server, by resumption of session', ('resumed',))
+
+def remember_session(stream):
+	"""Call after first package from server, when session is known"""
+	if isinstance(ssl_context, common.utils.ResumingContext) and isinstance(stream, tornado.iostream.SSLIOStream) and not stream.closed():
+		tls_handshakes.labels('true' if stream.socket.session_reused else 'false').inc()
+		ssl_context.remember_session(stream.socket)
+
 def unexpected_package(package):
-	raise Exception('Unexpected package: '.format(package))
+	raise Exception('Unexpected package: {}'.format(package))
 
 @tornado.gen.coroutine
-def tunnel(client, stream, port):
+def tunnel(client, stream, port, latency_class, relay, timeline):
 	logging.debug('Requested to create tunnel with local port {}'.format(port))
 
 	package = yield common.protocol.package.read(stream)
 	if not isinstance(package, common.protocol.connect):
 		unexpected_package(package)
+	timeline.mark('connect_received')
 
 	logging.info('Connecting with local port {}...'.format(port))
 	local_client = tornado.tcpclient.TCPClient()
@@ -79,39 +113,226 @@ def tunnel(client, stream, port):
 	)
 
 	logging.info('Connection established with local port {}'.format(port))
-	proxy = common.proxy.Proxy('NATadm_server:{}'.format(package.original_client_address), stream, 'localhost:{}'.format(port), local_stream)
+	timeline.mark('local_connected')
+	if relay:
+		yield common.splice.relay('NATadm_server:{}'.format(package.original_client_address), stream, 'localhost:{}'.format(port), local_stream, timeline, port)
+		logging.debug('Relay closed')
+		return
+
+	proxy = common.proxy.Proxy('NATadm_server:{}'.format(package.original_client_address), stream, 'localhost:{}'.format(port), local_stream, tornado.options.options.proxy_write_window, latency_class, timeline, port)
 	yield proxy.run()
 
 	logging.debug('Closing tunnel...')
 	yield common.protocol.disconnect().write(stream)
 
+@tornado.gen.coroutine
+def connect():
+	remote = tornado.options.options.remote
+	logging.info('Trying to connect {}:{} (client name "{}")...'.format(remote[0], remote[1], tornado.options.options.name))
+	global ssl_context
+	if not tornado.options.options.plaintext:
+		ssl_context = common.utils.ssl_options(
+			certfile=tornado.options.options.certificate[0],
+			keyfile=tornado.options.options.certificate[1],
+			cacerts=tornado.options.options.cafile,
+			resume_sessions=True
+		)
+	client = tornado.tcpclient.TCPClient()
+	start = time.monotonic()
+	stream = yield client.connect(remote[0], remote[1], ssl_options=ssl_context)
+	common.metrics.histogram('server_connect_seconds', 'connection (with TLS handshake) with server').observe(time.monotonic() - start)
+	logging.debug('Connection established')
+	return (client, stream)
+
+@tornado.gen.coroutine
+def poll():
+	global server_protocol_version
+	while True:
+		(client, stream) = yield connect()
+		version = server_protocol_version
+		yield common.protocol.hello(tornado.options.options.name, version).write(stream)
+		if version >= common.protocol.BINARY_VERSION:
+			common.protocol.use_binary_format(stream)
+
+		package = yield common.protocol.package.read(stream)
+		remember_session(stream)
+		if isinstance(package, common.protocol.error) and package.version_rejected() and version > common.protocol.DEFAULT_VERSION:
+			logging.info('Server does not support protocol version {}, retrying with older one'.format(version))
+			stream.close()
+			server_protocol_version = min(server_protocol_version, version - 1)
+			continue
+		answered(client, stream, package)
+		return
+
+def answered(client, stream, package):
+	"""Handles answer of server to poll (or to standby connection)"""
+	if isinstance(package, common.protocol.create_tunnel):
+		tornado.ioloop.IOLoop.instance().add_callback(tunnel, client, stream, package.port, package.latency_class, package.relay, common.metrics.Timeline())
+		poll_pending(len(package.pending))
+	elif isinstance(package, common.protocol.not_interested):
+		logging.info('Nobody interested in tunnel, disconnecting')
+		stream.close()
+	else:
+		stream.close()
+		unexpected_package(package)
+
+@tornado.gen.coroutine
+def checked_poll():
+	try:
+		yield poll()
+	except Exception as e:
+		logging.exception(e)
+
+def poll_pending(count):
+	"""Polls for count tunnels pending at server, in parallel; polls already
+	started for them count in"""
+	global pending_polls
+	count -= pending_polls
+	if count > 0:
+		logging.info('Server has {} more pending requests, polling'.format(count))
+	for i in range(count):
+		pending_polls += 1
+		tornado.ioloop.IOLoop.instance().add_callback(pending_poll)
+
+@tornado.gen.coroutine
+def pending_poll():
+	global pending_polls
+	try:
+		yield checked_poll()
+	finally:
+		pending_polls -= 1
+
+@tornado.gen.coroutine
+def standby():
+	"""Parks connection at server, until server binds a user to it"""
+	(client, stream) = yield connect()
+	io_loop = tornado.ioloop.IOLoop.instance()
+	try:
+		yield common.protocol.hello(
+			tornado.options.options.name, common.protocol.MAX_VERSION, common.protocol.MODE_STANDBY
+		).write(stream)
+		package = yield common.protocol.package.read(stream)
+		remember_session(stream)
+		if isinstance(package, common.protocol.error):
+			logging.warning('Server does not accept standby connections ({}), not opening them'.format(package.message))
+			tornado.options.options.standby_connections = 0
+			stream.close()
+			return
+		if not isinstance(package, common.protocol.hello):
+			unexpected_package(package)
+		if package.protocol_version >= common.protocol.BINARY_VERSION:
+			common.protocol.use_binary_format(stream)
+		logging.debug('Standby connection parked at server')
+		while True:
+			package = yield tornado.gen.with_timeout(io_loop.time() + 3*common.protocol.STANDBY_KEEPALIVE_INTERVAL, common.protocol.package.read(stream))
+			if not isinstance(package, common.protocol.keepalive):
+				break
+	except tornado.gen.TimeoutError:
+		logging.warning('Standby connection timed out, reconnecting')
+		stream.close()
+		return
+	except:
+		stream.close()
+		raise
+	logging.info('Server bound user to standby connection')
+	answered(client, stream, package)
+
+@tornado.gen.coroutine
+def keep_standby():
+	"""Keeps one standby connection parked at server"""
+	while tornado.options.options.standby_connections:
+		try:
+			yield standby()
+		except Exception as e:
+			logging.exception(e)
+			yield tornado.gen.Task(
+				tornado.ioloop.IOLoop.instance().add_timeout,
+				time.time()+tornado.options.options.interval
+			)
+
+@tornado.gen.coroutine
+def mux_tunnel(mux_stream, package):
+	timeline = common.metrics.Timeline()
+	logging.info('Connecting with local port {}...'.format(package.port))
+	try:
+		local_stream = yield tornado.tcpclient.TCPClient().connect('localhost', package.port)
+	except Exception as e:
+		logging.warning('Could not connect with local port {}: {}'.format(package.port, e))
+		yield common.protocol.disconnect().write(mux_stream)
+		return
+
+	logging.info('Connection established with local port {}'.format(package.port))
+	timeline.mark('local_connected')
+	proxy = common.proxy.Proxy('NATadm_server:{}#{}'.format(package.original_client_address, mux_stream.stream_id), mux_stream, 'localhost:{}'.format(package.port), local_stream, tornado.options.options.proxy_write_window, package.latency_class, timeline, package.port)
+	try:
+		yield proxy.run()
+	except Exception as e:
+		logging.exception(e)
+	logging.debug('Tunnel #{} closed'.format(mux_stream.stream_id))
+
+@tornado.gen.coroutine
+def handle_control_package(channel, package):
+	if isinstance(package, common.protocol.wakeup):
+		logging.info('Server has pending requests, polling')
+		tornado.ioloop.IOLoop.instance().add_callback(checked_poll)
+	elif not isinstance(package, common.protocol.keepalive):
+		unexpected_package(package)
+
+@tornado.gen.coroutine
+def control_channel():
+	(client, stream) = yield connect()
+	interval = tornado.options.options.interval
+	io_loop = tornado.ioloop.IOLoop.instance()
+	try:
+		yield common.protocol.hello(
+			tornado.options.options.name, common.protocol.MAX_VERSION, common.protocol.MODE_CONTROL
+		).write(stream)
+		package = yield common.protocol.package.read(stream)
+		remember_session(stream)
+		if isinstance(package, common.protocol.error):
+			logging.warning('Server does not support control channel ({}), falling back to polling'.format(package.message))
+			tornado.options.options.control_channel = False
+			return
+		if not isinstance(package, common.protocol.hello):
+			unexpected_package(package)
+		logging.info('Control channel established (protocol version: {})'.format(package.protocol_version))
+		global server_protocol_version
+		server_protocol_version = package.protocol_version
+		if server_protocol_version >= common.protocol.BINARY_VERSION:
+			common.protocol.use_binary_format(stream)
+	except:
+		stream.close()
+		raise
+
+	channel = common.protocol.Multiplexer(stream, package.protocol_version, handle_control_package, mux_tunnel)
+	# channel is not read while paused; it must not look timed out then
+	channel.pause_timeout = interval
+
+	def keepalive():
+		if io_loop.time() - channel.last_activity > 3*interval:
+			logging.warning('Control channel timed out, reconnecting')
+			stream.close()
+		else:
+			channel.write(common.protocol.keepalive())
+
+	keepalive_callback = tornado.ioloop.PeriodicCallback(keepalive, interval*1000)
+	keepalive_callback.start()
+	try:
+		yield channel.run()
+	finally:
+		keepalive_callback.stop()
+
 @tornado.gen.coroutine
 def main():
 	logging.info('=== NATadm client (protocol version: {}) ==='.format(common.protocol.MAX_VERSION))
+	if tornado.options.options.plaintext:
+		logging.warning('Connections with server are not encrypted nor authenticated; use on trusted networks only')
 	while True:
 		try:
-			remote = tornado.options.options.remote
-			logging.info('Trying to connect {}:{} (client name "{}")...'.format(remote[0], remote[1], tornado.options.options.name))
-			client = tornado.tcpclient.TCPClient()
-			stream = yield client.connect(
-				remote[0], remote[1], ssl_options=common.utils.ssl_options(
-					certfile=tornado.options.options.certificate[0],
-					keyfile=tornado.options.options.certificate[1],
-					cacerts=tornado.options.options.cafile
-				)
-			)
-			logging.debug('Connection established')
-			yield common.protocol.hello(tornado.options.options.name).write(stream)
-
-			package = yield common.protocol.package.read(stream)
-			if isinstance(package, common.protocol.create_tunnel):
-				tornado.ioloop.IOLoop.instance().add_callback(tunnel, client, stream, package.port)
-			elif isinstance(package, common.protocol.not_interested):
-				logging.info('Nobody interested in tunnel, disconnecting')
-				stream.close()
+			if tornado.options.options.control_channel:
+				yield control_channel()
 			else:
-				unexpected_package(package)
-
+				yield poll()
 		except Exception as e:
 			logging.exception(e)
 
@@ -127,4 +348,11 @@ def main():
 
 io_loop = tornado.ioloop.IOLoop.instance()
 io_loop.add_callback(main)
+if tornado.options.options.infinite:
+	for i in range(tornado.options.options.standby_connections):
+		io_loop.add_callback(keep_standby)
+if tornado.options.options.metrics_interval:
+	tornado.ioloop.PeriodicCallback(common.metrics.log_summaries, tornado.options.options.metrics_interval*1000).start()
+if tornado.options.options.traffic_log_interval:
+	tornado.ioloop.PeriodicCallback(common.proxy.log_traffic, tornado.options.options.traffic_log_interval*1000).start()
 io_loop.start()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Rendezvous of users and clients between worker processes of server.
+
+With SO_REUSEPORT, user connecting to a service and client polling for it
+(or holding its control channel) are accepted by any of the workers. The
+broker process keeps requests of all workers and knows which worker holds
+control channel of which client. Worker, that takes a request of another
+worker, connects to that worker's rendezvous socket and gets the user's
+socket passed to it (SCM_RIGHTS), so workers never move bytes of each
+other's tunnels.
+
+Workers and the broker exchange JSON messages, one per line, over Unix
+sockets.
+"""
+
+import array
+import base64
+import collections
+import itertools
+import json
+import logging
+import os.path
+import socket
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+
+import common.metrics
+import common.utils
+
+BROKER_SOCKET = 'broker.sock'
+
+def worker_socket(worker):
+	return 'worker-{}.sock'.format(worker)
+
+@tornado.gen.coroutine
+def connect_unix(path):
+	stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+	yield stream.connect(path)
+	return stream
+
+@tornado.gen.coroutine
+def read_message(stream):
+	line = yield stream.read_until(b'\n')
+	return json.loads(line.decode('utf-8'))
+
+def write_message(stream, message):
+	return stream.write(json.dumps(message).encode('utf-8') + b'\n')
+
+@tornado.gen.coroutine
+def receive_stream(sock):
+	"""Stream of socket passed through Unix socket sock by pass_socket"""
+	yield common.utils.wait_for_fd(sock, tornado.ioloop.IOLoop.READ)
+	fds = array.array('i')
+	(line, ancdata, flags, address) = sock.recvmsg(4096, socket.CMSG_SPACE(fds.itemsize))
+	for (level, kind, data) in ancdata:
+		if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+			fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+	if not fds:
+		raise Exception('No socket received: {!r}'.format(line))
+	if not line.endswith(b'\n'):
+		# descriptor came with the first part of the message only; nothing
+		# follows the message, so the reader may close sock
+		reader = tornado.iostream.IOStream(sock)
+		try:
+			line += yield reader.read_until(b'\n')
+		finally:
+			reader.close()
+	header = json.loads(line.decode('utf-8'))
+	stream = tornado.iostream.IOStream(socket.socket(header['family'], header['type'], 0, fileno=fds[0]))
+	stream.unread(base64.b64decode(header['data']))
+	return stream
+
+@tornado.gen.coroutine
+def pass_socket(sock, passed, data):
+	"""Passes socket (and data already read from it) through non-blocking
+	Unix socket sock, using SCM_RIGHTS"""
+	line = json.dumps({
+		# needed to rebuild socket object from descriptor
+		'family': int(passed.family), 'type': int(passed.type),
+		'data': base64.b64encode(data).decode('ascii'),
+	}).encode('utf-8') + b'\n'
+	fds = array.array('i', [passed.fileno()])
+	while True:
+		try:
+			sent = sock.sendmsg([line], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+			break
+		except BlockingIOError:
+			yield common.utils.wait_for_fd(sock, tornado.ioloop.IOLoop.WRITE)
+	if sent < len(line):
+		# descriptor went with the first part of the message; the writer
+		# may close sock, as nothing follows the message
+		writer = tornado.iostream.IOStream(sock)
+		try:
+			yield writer.write(line[sent:])
+		finally:
+			writer.close()
+
+def take_from(table, name, count = None):
+	"""Removes up to count (all, if None) oldest requests from queue of client
+	in table (client name -> deque of requests)"""
+	queue = table.get(name, ())
+	count = len(queue) if count is None else min(count, len(queue))
+	requests = [queue.popleft() for i in range(count)]
+	if not queue:
+		table.pop(name, None)
+	return requests
+
+def withdraw_from(table, name, worker, request_id):
+	"""Removes request of user, which disconnected, from queue of client in
+	table"""
+	queue = table.get(name, ())
+	for request in queue:
+		if request['worker'] == worker and request['id'] == request_id:
+			queue.remove(request)
+			break
+	if not queue:
+		table.pop(name, None)
+
+class Broker(tornado.tcpserver.TCPServer):
+	"""Pending requests (client name -> queue of requests), owners of
+	control channels (client name -> stream of worker) and of standby
+	connections (client name -> list of streams of workers, one for each
+	connection) of all workers"""
+	def __init__(self, *args, **kwargs):
+		super(Broker, self).__init__(*args, **kwargs)
+		self.requests = dict()
+		self.channels = dict()
+		# names of clients, whose control channels carry tunnels
+		self.mux_channels = set()
+		self.standby = dict()
+
+	def notify(self, name):
+		if not self.requests.get(name):
+			return
+		# multiplexed tunnel needs no new connection, standby connection is
+		# already established, wakeup makes client connect
+		stream = self.channels.get(name)
+		if name not in self.mux_channels and self.standby.get(name):
+			stream = self.standby[name][0]
+		if stream is not None:
+			write_message(stream, {'op': 'notify', 'client': name})
+
+	@tornado.gen.coroutine
+	def handle_stream(self, stream, address):
+		worker = None
+		try:
+			while True:
+				message = yield read_message(stream)
+				op = message['op']
+				if op == 'hello':
+					worker = message['worker']
+					logging.info('Worker {} connected to broker'.format(worker))
+				elif op == 'request':
+					self.requests.setdefault(message['client'], collections.deque()).append(message)
+					self.notify(message['client'])
+				elif op == 'withdraw':
+					withdraw_from(self.requests, message['client'], message['worker'], message['id'])
+				elif op == 'take':
+					requests = take_from(self.requests, message['client'], message['count'])
+					pending = [request['port'] for request in self.requests.get(message['client'], ())]
+					write_message(stream, {'op': 'taken', 'seq': message['seq'], 'requests': requests, 'pending': pending})
+				elif op == 'channel_opened':
+					self.channels[message['client']] = stream
+					if message['mux']:
+						self.mux_channels.add(message['client'])
+					else:
+						self.mux_channels.discard(message['client'])
+					self.notify(message['client'])
+				elif op == 'channel_closed':
+					if self.channels.get(message['client']) is stream:
+						del self.channels[message['client']]
+						self.mux_channels.discard(message['client'])
+				elif op == 'standby_parked':
+					self.standby.setdefault(message['client'], []).append(stream)
+					self.notify(message['client'])
+				elif op == 'standby_unparked':
+					owners = self.standby.get(message['client'], [])
+					if stream in owners:
+						owners.remove(stream)
+					if not owners:
+						self.standby.pop(message['client'], None)
+				else:
+					raise Exception('Unknown message from worker {}: {}'.format(worker, message))
+		except tornado.iostream.StreamClosedError:
+			logging.warning('Worker {} disconnected from broker'.format(worker))
+		except Exception as e:
+			logging.exception(e)
+		finally:
+			stream.close()
+			for name in [name for name, owner in self.channels.items() if owner is stream]:
+				del self.channels[name]
+				self.mux_channels.discard(name)
+			for name, owners in list(self.standby.items()):
+				self.standby[name] = [owner for owner in owners if owner is not stream]
+				if not self.standby[name]:
+					del self.standby[name]
+			# users of requests of that worker are gone with it
+			for name, queue in list(self.requests.items()):
+				self.requests[name] = collections.deque(request for request in queue if request['worker'] != worker)
+				if not self.requests[name]:
+					del self.requests[name]
+
+class RemoteUser:
+	"""User waiting in (possibly) another worker, as server_port of request"""
+	def __init__(self, broker, request):
+		self.broker = broker
+		self.worker = request['worker']
+		self.id = request['id']
+		self.address = tuple(request['address'])
+		self.latency_class = request['latency_class']
+
+	@tornado.gen.coroutine
+	def accept(self):
+		if self.worker == self.broker.worker:
+			if self.id not in self.broker.users:
+				raise Exception('User {} is not waiting anymore'.format(self.address))
+			return self.broker.take_user(self.id)
+		logging.info('Taking user {} from worker {}'.format(self.address, self.worker))
+		stream = yield connect_unix(os.path.join(self.broker.directory, worker_socket(self.worker)))
+		yield write_message(stream, {'op': 'pass', 'id': self.id})
+		(sock, data) = stream.detach()
+		try:
+			return ((yield receive_stream(sock)), self.address)
+		finally:
+			sock.close()
+
+class BrokerClient(tornado.tcpserver.TCPServer):
+	"""Connection of worker with the broker; also listens on rendezvous
+	socket of the worker, passing its users to other workers"""
+	def __init__(self, directory, worker, notify, *args, **kwargs):
+		super(BrokerClient, self).__init__(*args, **kwargs)
+		self.directory = directory
+		self.worker = worker
+		self.notify = notify
+		self.stream = None
+		self.users = dict()
+		self.ids = itertools.count(1)
+		self.seqs = itertools.count(1)
+		self.waiting = dict()
+
+	@tornado.gen.coroutine
+	def start(self):
+		self.add_socket(tornado.netutil.bind_unix_socket(os.path.join(self.directory, worker_socket(self.worker))))
+		self.stream = yield connect_unix(os.path.join(self.directory, BROKER_SOCKET))
+		yield write_message(self.stream, {'op': 'hello', 'worker': self.worker})
+		tornado.ioloop.IOLoop.instance().add_callback(self.run)
+
+	@tornado.gen.coroutine
+	def run(self):
+		try:
+			while True:
+				message = yield read_message(self.stream)
+				if message['op'] == 'taken':
+					self.waiting.pop(message['seq']).set_result(message)
+				elif message['op'] == 'notify':
+					tornado.ioloop.IOLoop.instance().add_callback(self.notify, message['client'])
+		except Exception as e:
+			logging.error('Lost connection with broker: {}'.format(e))
+			tornado.ioloop.IOLoop.instance().stop()
+
+	def add_request(self, name, client_port, latency_class, stream, address):
+		request_id = next(self.ids)
+		self.users[request_id] = (stream, address, common.utils.CloseWatcher(stream, lambda: self.user_left(name, request_id)))
+		return write_message(self.stream, {
+			'op': 'request', 'client': name, 'port': client_port, 'latency_class': latency_class,
+			'worker': self.worker, 'id': request_id, 'address': address,
+			# monotonic clock is common to all processes of the machine
+			'queued': time.monotonic(),
+		})
+
+	def user_left(self, name, request_id):
+		(stream, address, watcher) = self.users.pop(request_id)
+		logging.info('User {} disconnected before client \"{}\" came'.format(address, name))
+		return write_message(self.stream, {'op': 'withdraw', 'client': name, 'worker': self.worker, 'id': request_id})
+
+	def take_user(self, request_id):
+		"""Removes waiting user, as (stream, address)"""
+		(stream, address, watcher) = self.users.pop(request_id)
+		watcher.stop()
+		return (stream, address)
+
+	@tornado.gen.coroutine
+	def take_requests(self, name, count = None):
+		"""Up to count (all, if None) oldest requests for client, as entries
+		of requests table, and ports of requests left in queue"""
+		seq = next(self.seqs)
+		future = self.waiting[seq] = tornado.concurrent.Future()
+		yield write_message(self.stream, {'op': 'take', 'client': name, 'count': count, 'seq': seq})
+		message = yield future
+		requests = [
+			(request['port'], RemoteUser(self, request), tuple(request['address']), common.metrics.Timeline(request['queued']))
+			for request in message['requests']
+		]
+		return (requests, message['pending'])
+
+	def channel_opened(self, name, mux):
+		"""mux - whether tunnels go over the channel, instead of wakeups"""
+		return write_message(self.stream, {'op': 'channel_opened', 'client': name, 'mux': mux})
+
+	def channel_closed(self, name):
+		return write_message(self.stream, {'op': 'channel_closed', 'client': name})
+
+	def standby_parked(self, name):
+		return write_message(self.stream, {'op': 'standby_parked', 'client': name})
+
+	def standby_unparked(self, name):
+		return write_message(self.stream, {'op': 'standby_unparked', 'client': name})
+
+	@tornado.gen.coroutine
+	def handle_stream(self, stream, address):
+		"""Another worker took request of user waiting here"""
+		try:
+			message = yield read_message(stream)
+			if message['id'] not in self.users:
+				logging.warning('Request {} taken by another worker, but its user is not waiting anymore'.format(message['id']))
+				return
+			(user_stream, user_address) = self.take_user(message['id'])
+			# data of user read while watching it are put back into stream
+			(user_socket, user_data) = user_stream.detach()
+			logging.info('Passing user {} to another worker'.format(user_address))
+			(sock, data) = stream.detach()
+			try:
+				yield pass_socket(sock, user_socket, user_data)
+			finally:
+				sock.close()
+				user_socket.close()
+		except Exception as e:
+			logging.exception(e)
+		finally:
+			if not stream.closed():
+				stream.close()
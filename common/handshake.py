@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import concurrent.futures
+import ssl
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+
+import common.utils
+
+# Seconds for whole handshake, including waiting for slow clients
+HANDSHAKE_TIMEOUT = 30
+
+class HandshakePool:
+	"""Runs server side TLS handshakes in a pool of threads.
+
+	Each step of handshake (with RSA/ECDHE computations) runs in a thread;
+	OpenSSL releases the GIL for it, so a burst of connecting clients does
+	not stall the IOLoop. Waiting for the socket between steps is left to
+	the IOLoop, so slow clients do not hold threads.
+	"""
+	def __init__(self, ssl_options, threads):
+		self.ssl_options = ssl_options
+		self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+	@staticmethod
+	def step(sock):
+		"""IOLoop events to wait for before next step, None when done"""
+		try:
+			sock.do_handshake()
+		except ssl.SSLWantReadError:
+			return tornado.ioloop.IOLoop.READ
+		except ssl.SSLWantWriteError:
+			return tornado.ioloop.IOLoop.WRITE
+		return None
+
+	@tornado.gen.coroutine
+	def handshake(self, stream):
+		"""SSLIOStream of plain stream accepted by server, after handshake"""
+		(sock, data) = stream.detach()
+		sock = tornado.netutil.ssl_wrap_socket(sock, self.ssl_options, server_side=True, do_handshake_on_connect=False)
+		try:
+			deadline = tornado.ioloop.IOLoop.instance().time() + HANDSHAKE_TIMEOUT
+			while True:
+				events = yield self.executor.submit(self.step, sock)
+				if events is None:
+					break
+				yield tornado.gen.with_timeout(deadline, common.utils.wait_for_fd(sock, events))
+		except Exception:
+			tornado.ioloop.IOLoop.instance().remove_handler(sock)
+			sock.close()
+			raise
+		# stream only confirms (on its first event) that handshake is done
+		return tornado.iostream.SSLIOStream(sock, ssl_options=self.ssl_options)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import bisect
+import collections
+import logging
+import time
+
+import tornado.ioloop
+
+# Prefix of names of all metrics in exposition format
+NAMESPACE = 'natadm_'
+
+# Upper bounds (in seconds) of histogram buckets; from sub-millisecond local
+# connects up to client poll intervals
+DEFAULT_BUCKETS = (
+	0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+	1, 2.5, 5, 10, 30, 60, 120, 300,
+)
+
+# Phases of tunnel setup, measured from the moment user is accepted (on
+# server), or tunnel is requested (on client)
+SETUP_PHASES = collections.OrderedDict([
+	('queued', 'request queued in requests table'),
+	('client_reached', 'client polled, or request taken over its control channel'),
+	('tunnel_requested', 'create_tunnel (or stream_open) sent to client'),
+	('connect_sent', 'connect sent to polling client'),
+	('connect_received', 'connect received from server'),
+	('local_connected', 'connection with local service established'),
+	('first_raw', 'first payload from raw side (user on server, local service on client)'),
+	('first_wrapped', 'first payload through tunnel (from client on server, from server on client)'),
+])
+
+class Value:
+	__slots__ = ('value',)
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, amount = 1):
+		self.value += amount
+
+	def dec(self, amount = 1):
+		self.value -= amount
+
+	def set(self, value):
+		self.value = value
+
+class Counter:
+	"""Value (or values, one for each combination of labels) that only grows"""
+	type = 'counter'
+
+	def __init__(self, name, help, labels = ()):
+		self.name = name
+		self.help = help
+		self.label_names = tuple(labels)
+		self.values = collections.OrderedDict()
+		if not self.label_names:
+			self.labels()
+
+	def labels(self, *label_values):
+		"""Value for given labels; hot paths should keep it, instead of
+		looking it up each time"""
+		label_values = tuple(str(v) for v in label_values)
+		value = self.values.get(label_values)
+		if value is None:
+			value = self.values[label_values] = Value()
+		return value
+
+	def inc(self, amount = 1):
+		self.labels().inc(amount)
+
+	def samples(self):
+		for label_values, value in self.values.items():
+			yield (self.name, dict(zip(self.label_names, label_values)), value.value)
+
+class Gauge(Counter):
+	"""Value that may go up and down, or is read from function when exported"""
+	type = 'gauge'
+
+	def __init__(self, name, help, labels = (), function = None):
+		super(Gauge, self).__init__(name, help, labels)
+		self.function = function
+
+	def dec(self, amount = 1):
+		self.labels().dec(amount)
+
+	def set(self, value):
+		self.labels().set(value)
+
+	def samples(self):
+		if self.function is not None:
+			yield (self.name, {}, self.function())
+		else:
+			yield from super(Gauge, self).samples()
+
+class Histogram:
+	"""Distribution of observed values, in cumulative buckets"""
+	type = 'histogram'
+
+	def __init__(self, name, help, buckets = DEFAULT_BUCKETS):
+		self.name = name
+		self.help = help
+		self.buckets = buckets
+		self.counts = [0]*(len(buckets)+1)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def cumulative(self):
+		"""(upper bound, count of values not greater) for each bucket, +Inf last"""
+		total = 0
+		for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+			total += count
+			yield (bound, total)
+
+	def quantile(self, q):
+		"""Upper bound of bucket holding q-quantile; NaN if nothing was
+		observed"""
+		if not self.count:
+			return float('nan')
+		rank = q*self.count
+		for bound, total in self.cumulative():
+			if total >= rank:
+				return bound
+		return float('inf')
+
+	def summary(self):
+		return '{}: {} samples, avg {:.4f} s, p50 <= {} s, p99 <= {} s'.format(
+			self.name, self.count, self.sum/self.count if self.count else 0,
+			self.quantile(0.5), self.quantile(0.99)
+		)
+
+	def samples(self):
+		for bound, total in self.cumulative():
+			yield (self.name + '_bucket', {'le': bound}, total)
+		yield (self.name + '_sum', {}, self.sum)
+		yield (self.name + '_count', {}, self.count)
+
+registry = collections.OrderedDict()
+
+def register(cls, name, *args, **kwargs):
+	if name not in registry:
+		registry[name] = cls(name, *args, **kwargs)
+	return registry[name]
+
+def counter(name, help, labels = ()):
+	return register(Counter, name, help, labels)
+
+def gauge(name, help, labels = (), function = None):
+	return register(Gauge, name, help, labels, function)
+
+def histogram(name, help):
+	return register(Histogram, name, help)
+
+def setup_histogram(phase):
+	return histogram('tunnel_setup_{}_seconds'.format(phase), SETUP_PHASES[phase])
+
+class Timeline:
+	"""Phases of setup of single tunnel; each is recorded once, as time
+	since creation of the timeline (or given time.monotonic() value)"""
+	def __init__(self, start = None):
+		self.start = time.monotonic() if start is None else start
+		self.marked = set()
+
+	def mark(self, phase):
+		if phase in self.marked:
+			return
+		self.marked.add(phase)
+		setup_histogram(phase).observe(time.monotonic() - self.start)
+
+class LoopLagMonitor:
+	"""Measures how late IOLoop runs timeouts, which is how long ready
+	events wait for callbacks hogging the loop"""
+	def __init__(self, interval = 0.5):
+		self.interval = interval
+		self.histogram = histogram('event_loop_lag_seconds', 'delay of IOLoop timeouts')
+		self.io_loop = tornado.ioloop.IOLoop.instance()
+
+	def start(self):
+		self.expected = self.io_loop.time() + self.interval
+		self.io_loop.add_timeout(self.expected, self.check)
+
+	def check(self):
+		self.histogram.observe(max(0, self.io_loop.time() - self.expected))
+		self.start()
+
+def format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(value) if isinstance(value, float) else str(value)
+
+def format_labels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(name, format_value(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+		for name, value in labels.items()) + '}'
+
+def exposition():
+	"""All metrics, in Prometheus text exposition format"""
+	lines = []
+	for metric in registry.values():
+		name = NAMESPACE + metric.name
+		lines.append('# HELP {} {}'.format(name, metric.help))
+		lines.append('# TYPE {} {}'.format(name, metric.type))
+		for sample_name, labels, value in metric.samples():
+			lines.append('{}{}{} {}'.format(NAMESPACE, sample_name, format_labels(labels), format_value(value)))
+	return '\n'.join(lines) + '\n'
+
+_logged_counts = dict()
+
+def log_summaries():
+	"""Logs histograms that got new values since last call"""
+	for name, metric in registry.items():
+		if isinstance(metric, Histogram) and metric.count != _logged_counts.get(name):
+			_logged_counts[name] = metric.count
+			logging.info(metric.summary())
@@ -15,47 +15,190 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import io
+import json
 import logging
 import os
 import pickle
+import struct
 import sys
-import unittest
 
+import tornado.concurrent
 import tornado.gen
+import tornado.ioloop
+import tornado.iostream
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
 import common.utils
 
+# Version negotiation:
+# - control channel and standby connections: client sends MAX_VERSION in its
+#   hello, server answers with hello of the lower of both versions, used by
+#   both sides since then;
+# - polls: server does not answer hello, so client sends the newest version
+#   it expects server to accept (the one agreed over control channel, or
+#   MAX_VERSION), stepping down while server rejects it (TOO_NEW_VERSION);
+# - hello itself is always in legacy (pickle) format, as it precedes any
+#   agreement.
+# DEFAULT_VERSION is the version of hello constructed without one, and the
+# oldest one polls step down to; servers accept it from old clients, which
+# do not negotiate at all.
 DEFAULT_VERSION = 2
-MAX_VERSION = 2
+MAX_VERSION = 8
+
+# First protocol version, in which client may keep persistent control channel
+CONTROL_VERSION = 3
+# First protocol version, in which tunnels are multiplexed over control channel
+MUX_VERSION = 4
+# First protocol version, in which packages are sent in binary format instead of pickle
+BINARY_VERSION = 5
+# First protocol version, in which polled tunnel may carry raw bytes after CONNECT
+RELAY_VERSION = 6
+# First protocol version, in which client may park standby connections at server
+STANDBY_VERSION = 7
+# First protocol version, in which writers of multiplexed streams wait for
+# window granted by readers
+WINDOW_VERSION = 8
+
+# Binary package header: marker, type, stream id, length of body. Marker is
+# the same as encoded length of empty pickle, so it never starts a legacy package.
+BINARY_MARKER = 0x80
+BINARY_HEADER = struct.Struct('!BBII')
+
+# Longest accepted encoded length of legacy (pickle) package
+MAX_LENGTH_SIZE = 10
+
+# Bytes of payload queued for single multiplexed stream, above which the
+# whole connection is not read until the stream's reader catches up (only
+# peers older than WINDOW_VERSION get that far)
+MUX_STREAM_BUFFER = 1024*1024
+
+# Seconds, for which connection may stay not read because of single stream;
+# then the stream is closed, so that others (and keepalives) go on
+MUX_PAUSE_TIMEOUT = 10
+
+# Bytes, which writer of multiplexed stream may send before the reader grants
+# more (since WINDOW_VERSION); the same at both sides
+MUX_STREAM_WINDOW = MUX_STREAM_BUFFER
+
+# Start of error message sent for hello of version newer than MAX_VERSION (the
+# same in all versions, so clients can step down to older one)
+TOO_NEW_VERSION = 'Too new protocol version'
+
+MODE_POLL = 'poll'
+MODE_CONTROL = 'control'
+# connection waiting at server, answered as a poll when a user connects
+MODE_STANDBY = 'standby'
+
+# Seconds between keepalives sent by server over parked standby connections
+STANDBY_KEEPALIVE_INTERVAL = 30
+
+# Latency classes of services: interactive tunnels (e.g. SSH sessions) are
+# served before bulk ones (e.g. file transfers)
+LATENCY_INTERACTIVE = 'interactive'
+LATENCY_BULK = 'bulk'
+
+def use_binary_format(stream):
+	"""Makes all packages written to stream use binary format.
+
+	Should be called only after both sides agreed on protocol version
+	(BINARY_VERSION or newer); reading detects format of each package.
+	"""
+	stream.natadm_binary_format = True
+
+class _Unpickler(pickle.Unpickler):
+	"""Loads only packages of this protocol, for legacy (pickle) format"""
+	def find_class(self, module, name):
+		cls = WIRE_CLASSES.get(name)
+		if cls is None or module not in ('common.protocol', __name__):
+			raise pickle.UnpicklingError('Forbidden class in package: {}.{}'.format(module, name))
+		return cls
 
 class package:
+	# in binary format, body of package is raw payload instead of JSON-encoded fields
+	raw_payload = False
+
 	@staticmethod
 	@tornado.gen.coroutine
 	def read(stream):
 		if isinstance(stream, bytes):
 			stream = common.utils.FileIOStream(io.BytesIO(stream))
-		length = []
-		while True:
-			b = (yield stream.read_bytes(1))[0]
-			length.append(int(b))
-			if b & 0x80:
-				break;
-		length = package._decode_length(length)
-		logging.debug('Reading package of {} B'.format(length))
-		pkg = yield stream.read_bytes(length)
-		logging.debug('Read package of {} B{}'.format(len(pkg), '' if len(pkg) > 100 else ' ({!r})'.format(pkg)))
-		return pickle.loads(pkg)
+		if isinstance(stream, MuxStream):
+			return (yield stream.read_package())
+		frame = yield stream.read_frame(package._frame_size)
+		if frame[0] == BINARY_MARKER:
+			(type_id, stream_id) = BINARY_HEADER.unpack_from(frame)[1:3]
+			return package._decode_binary(type_id, stream_id, frame[BINARY_HEADER.size:])
+		pkg = frame[package._length_size(frame):]
+		if logging.getLogger().isEnabledFor(logging.DEBUG):
+			logging.debug('Read package of {} B{}'.format(len(pkg), '' if len(pkg) > 100 else ' ({!r})'.format(pkg)))
+		return _Unpickler(io.BytesIO(pkg)).load()
+
+	@staticmethod
+	def _frame_size(data):
+		"""Size of package (with header) starting data, None if header is incomplete"""
+		if data[0] == BINARY_MARKER:
+			if len(data) < BINARY_HEADER.size:
+				return None
+			return BINARY_HEADER.size + BINARY_HEADER.unpack_from(data)[3]
+		header_size = package._length_size(data)
+		if header_size is None:
+			return None
+		return header_size + package._decode_length(data[:header_size])
+
+	@staticmethod
+	def _length_size(data):
+		for i in range(min(len(data), MAX_LENGTH_SIZE)):
+			if data[i] & 0x80:
+				return i+1
+		if len(data) >= MAX_LENGTH_SIZE:
+			raise Exception('Invalid length of package')
+		return None
 
 	@tornado.gen.coroutine
 	def write(self, stream):
-		b = pickle.dumps(self)
-		logging.debug('Writing package of {} B{}'.format(len(b), '' if len(b) > 100 else ' ({!r})'.format(b)))
-		length = package._encode_length(len(b))
-		yield stream.write(length)
-		yield stream.write(b)
+		if isinstance(stream, MuxStream):
+			yield stream.write_package(self)
+			return
+		if getattr(stream, 'natadm_binary_format', False):
+			(header, b) = self._encode_binary()
+		else:
+			b = pickle.dumps(self)
+			header = package._encode_length(len(b))
+		# formatting is skipped, as this runs for every frame
+		if logging.getLogger().isEnabledFor(logging.DEBUG):
+			logging.debug('Writing package of {} B{}'.format(len(b), '' if len(b) > 100 else ' ({!r})'.format(b)))
+		# both parts are queued (and sent) at once, so packages written concurrently
+		# to the same stream (e.g. control channel) are never interleaved
+		yield stream.writev((header, b))
+
+	def _encode_binary(self):
+		fields = dict(self.__dict__)
+		stream_id = fields.pop('stream_id', 0)
+		if self.raw_payload:
+			body = fields['payload']
+		elif fields:
+			body = json.dumps(fields).encode('utf-8')
+		else:
+			body = b''
+		header = BINARY_HEADER.pack(BINARY_MARKER, WIRE_TYPES[type(self)], stream_id, len(body))
+		return (header, body)
+
+	@staticmethod
+	def _decode_binary(type_id, stream_id, body):
+		cls = WIRE_TYPE_CLASSES.get(type_id)
+		if cls is None:
+			raise Exception('Unknown package type: {}'.format(type_id))
+		pkg = cls.__new__(cls)
+		if cls.raw_payload:
+			pkg.payload = body
+		elif body:
+			pkg.__dict__.update(json.loads(body.decode('utf-8')))
+		if stream_id:
+			pkg.stream_id = stream_id
+		return pkg
 
 	@staticmethod
 	def _encode_length(length):
@@ -86,20 +229,44 @@ class package:
 		return output
 
 class hello(package):
-	def __init__(self, name, protocol_version = DEFAULT_VERSION):
+	# clients older than CONTROL_VERSION do not send mode at all
+	mode = MODE_POLL
+
+	def __init__(self, name, protocol_version = DEFAULT_VERSION, mode = MODE_POLL):
 		self.name = name
 		self.protocol_version = protocol_version
+		self.mode = mode
 
 	def check_protocol_version(self):
 		if self.protocol_version > MAX_VERSION:
-			raise Exception('Too new protocol version: {}'.format(self.protocol_version))
+			raise Exception('{}: {}'.format(TOO_NEW_VERSION, self.protocol_version))
+
+	def negotiate_protocol_version(self):
+		if self.protocol_version < CONTROL_VERSION:
+			raise Exception('Too old protocol version for control channel: {}'.format(self.protocol_version))
+		return min(self.protocol_version, MAX_VERSION)
 
 class not_interested(package):
 	pass
 
+class wakeup(package):
+	pass
+
+class keepalive(package):
+	pass
+
 class create_tunnel(package):
-	def __init__(self, port):
+	# peers predating latency classes (or raw relay, or pending) do not send it
+	latency_class = LATENCY_INTERACTIVE
+	relay = False
+	# ports of further tunnels waiting for client; it may poll for them at once
+	pending = ()
+
+	def __init__(self, port, latency_class = LATENCY_INTERACTIVE, relay = False, pending = ()):
 		self.port = port
+		self.latency_class = latency_class
+		self.relay = relay
+		self.pending = list(pending)
 
 class connect(package):
 	def __init__(self, original_client_address):
@@ -109,6 +276,8 @@ class disconnect(package):
 	pass
 
 class payload(package):
+	raw_payload = True
+
 	def __init__(self, payload):
 		self.payload = payload
 
@@ -116,14 +285,292 @@ class error(package):
 	def __init__(self, message):
 		self.message = message
 
-class TestEncodeDecodeLength(unittest.TestCase):
-	def test_encode_decode(self):
-		for original in range(1, 2**24):
-			print('Checking {}'.format(original))
-			encoded = package._encode_length(original)
-			print('   encoded: {}'.format(repr(encoded)))
-			decoded = package._decode_length(encoded)
-			self.assertEqual(original, decoded)
-
-if __name__ == '__main__':
-	unittest.main()
\ No newline at end of file
+	def version_rejected(self):
+		"""True if peer rejected hello, because of too new protocol version"""
+		return self.message.startswith(TOO_NEW_VERSION)
+
+class stream_open(package):
+	latency_class = LATENCY_INTERACTIVE
+
+	def __init__(self, stream_id, port, original_client_address, latency_class = LATENCY_INTERACTIVE):
+		self.stream_id = stream_id
+		self.port = port
+		self.original_client_address = original_client_address
+		self.latency_class = latency_class
+
+class stream_data(package):
+	raw_payload = True
+
+	def __init__(self, stream_id, payload):
+		self.stream_id = stream_id
+		self.payload = payload
+
+class stream_close(package):
+	def __init__(self, stream_id):
+		self.stream_id = stream_id
+
+class stream_window(package):
+	"""Lets writer of the stream send size more bytes of payload"""
+	def __init__(self, stream_id, size):
+		self.stream_id = stream_id
+		self.size = size
+
+# identifiers of packages in binary format; must never be changed
+WIRE_TYPES = {
+	hello: 1,
+	not_interested: 2,
+	create_tunnel: 3,
+	connect: 4,
+	disconnect: 5,
+	payload: 6,
+	error: 7,
+	wakeup: 8,
+	keepalive: 9,
+	stream_open: 10,
+	stream_data: 11,
+	stream_close: 12,
+	stream_window: 13,
+}
+WIRE_TYPE_CLASSES = dict((type_id, cls) for (cls, type_id) in WIRE_TYPES.items())
+WIRE_CLASSES = dict((cls.__name__, cls) for cls in WIRE_TYPES)
+
+class MuxStream:
+	"""Single tunnel carried by Multiplexer.
+
+	May be passed to package.read and package.write instead of IOStream;
+	only payload and disconnect packages are transferred. Since
+	WINDOW_VERSION, payload beyond window granted by the peer waits in
+	unsent, and the peer is granted more as payload is read.
+	"""
+	def __init__(self, multiplexer, stream_id):
+		self.multiplexer = multiplexer
+		self.stream_id = stream_id
+		self.packages = collections.deque()
+		# bytes of payload in packages
+		self.buffered = 0
+		self.read_future = None
+		self.drain_future = None
+		self.window = MUX_STREAM_WINDOW
+		# (package, future of its writing), in order of writing
+		self.unsent = collections.deque()
+		# bytes of payload in unsent
+		self.unsent_bytes = 0
+		# bytes of payload read, not granted back to the peer yet
+		self.consumed = 0
+		self._closed = False
+
+	def feed(self, package):
+		if self.read_future is not None:
+			future = self.read_future
+			self.read_future = None
+			self.consume(package)
+			future.set_result(package)
+		else:
+			self.packages.append(package)
+			if isinstance(package, payload):
+				self.buffered += len(package.payload)
+
+	def consume(self, package):
+		if not isinstance(package, payload) or not self.multiplexer.windowed:
+			return
+		self.consumed += len(package.payload)
+		if self.consumed >= MUX_STREAM_WINDOW // 2 and not self._closed:
+			self.multiplexer.write(stream_window(self.stream_id, self.consumed))
+			self.consumed = 0
+
+	def drained(self, limit):
+		"""Future resolved when no more than limit bytes are queued (or
+		stream is closed)"""
+		future = tornado.concurrent.Future()
+		if self.buffered <= limit or self._closed:
+			future.set_result(None)
+		else:
+			self.drain_future = (future, limit)
+		return future
+
+	def read_package(self):
+		future = tornado.concurrent.Future()
+		if self.packages:
+			package = self.packages.popleft()
+			if isinstance(package, payload):
+				self.buffered -= len(package.payload)
+			self.consume(package)
+			future.set_result(package)
+			if self.drain_future is not None and self.buffered <= self.drain_future[1]:
+				self.drain_future[0].set_result(None)
+				self.drain_future = None
+		elif self._closed:
+			future.set_exception(tornado.iostream.StreamClosedError())
+		else:
+			self.read_future = future
+		return future
+
+	def write_package(self, package):
+		if self._closed:
+			raise tornado.iostream.StreamClosedError()
+		if isinstance(package, payload):
+			package = stream_data(self.stream_id, package.payload)
+		elif isinstance(package, disconnect):
+			package = stream_close(self.stream_id)
+		else:
+			raise Exception('Package cannot be sent over multiplexed stream: {}'.format(package))
+		if not self.multiplexer.windowed:
+			if isinstance(package, stream_close):
+				self.close()
+			return self.multiplexer.write(package)
+		future = tornado.concurrent.Future()
+		self.unsent.append((package, future))
+		if isinstance(package, stream_data):
+			self.unsent_bytes += len(package.payload)
+		self.send_unsent()
+		return future
+
+	def grant(self, size):
+		self.window += size
+		self.send_unsent()
+
+	def send_unsent(self):
+		while self.unsent and not self._closed:
+			(package, future) = self.unsent[0]
+			if isinstance(package, stream_close):
+				self.unsent.popleft()
+				self.close()
+				tornado.concurrent.chain_future(self.multiplexer.write(package), future)
+				return
+			if self.window <= 0:
+				return
+			# what does not fit into window is split off, and waits for more
+			chunk = package.payload[:self.window]
+			self.window -= len(chunk)
+			self.unsent_bytes -= len(chunk)
+			if len(chunk) < len(package.payload):
+				package.payload = package.payload[len(chunk):]
+				self.multiplexer.write(stream_data(self.stream_id, chunk))
+			else:
+				self.unsent.popleft()
+				tornado.concurrent.chain_future(self.multiplexer.write(package), future)
+
+	def write_buffer_size(self):
+		return self.multiplexer.stream.write_buffer_size() + self.unsent_bytes
+
+	def reset(self):
+		"""Closes stream at both sides, dropping data not read yet"""
+		if self._closed:
+			return
+		self.packages.clear()
+		self.buffered = 0
+		self.feed(disconnect())
+		self.multiplexer.write(stream_close(self.stream_id))
+		self.close()
+
+	def close(self):
+		if self._closed:
+			return
+		self._closed = True
+		self.multiplexer.forget(self)
+		if self.read_future is not None:
+			future = self.read_future
+			self.read_future = None
+			future.set_exception(tornado.iostream.StreamClosedError())
+		if self.drain_future is not None:
+			self.drain_future[0].set_result(None)
+			self.drain_future = None
+		while self.unsent:
+			self.unsent.popleft()[1].set_exception(tornado.iostream.StreamClosedError())
+		self.unsent_bytes = 0
+
+	def closed(self):
+		return self._closed
+
+class Multiplexer:
+	"""Carries many tunnels (MuxStream) over single connection.
+
+	Packages other than stream_* are passed to handle_package, opening of
+	streams by peer is reported to handle_open.
+	"""
+	def __init__(self, stream, protocol_version, handle_package, handle_open = None):
+		self.stream = stream
+		self.protocol_version = protocol_version
+		self.handle_package = handle_package
+		self.handle_open = handle_open
+		self.streams = dict()
+		self.next_stream_id = 1
+		self.last_activity = tornado.ioloop.IOLoop.instance().time()
+		self.stream_buffer = MUX_STREAM_BUFFER
+		self.pause_timeout = MUX_PAUSE_TIMEOUT
+		# not reading, while a stream has too much queued
+		self.paused = False
+		self.windowed = protocol_version >= WINDOW_VERSION
+		# small packages of interactive tunnels must not wait for ACKs of bulk ones
+		stream.set_nodelay(True)
+
+	def write(self, package):
+		return package.write(self.stream)
+
+	@tornado.gen.coroutine
+	def open(self, port, original_client_address, latency_class = LATENCY_INTERACTIVE):
+		mux_stream = MuxStream(self, self.next_stream_id)
+		self.next_stream_id += 1
+		self.streams[mux_stream.stream_id] = mux_stream
+		yield self.write(stream_open(mux_stream.stream_id, port, original_client_address, latency_class))
+		return mux_stream
+
+	def forget(self, mux_stream):
+		if self.streams.get(mux_stream.stream_id) is mux_stream:
+			del self.streams[mux_stream.stream_id]
+
+	@tornado.gen.coroutine
+	def pause(self, mux_stream):
+		"""Stops reading, until the stream's reader catches up (TCP stops the
+		peer meanwhile); the stream is closed, if it takes too long"""
+		self.paused = True
+		io_loop = tornado.ioloop.IOLoop.instance()
+		try:
+			yield tornado.gen.with_timeout(io_loop.time() + self.pause_timeout, mux_stream.drained(self.stream_buffer // 2))
+		except tornado.gen.TimeoutError:
+			logging.warning('Stream {} not read for {} s, closing it'.format(mux_stream.stream_id, self.pause_timeout))
+			mux_stream.reset()
+		finally:
+			self.paused = False
+		self.last_activity = io_loop.time()
+
+	@tornado.gen.coroutine
+	def run(self):
+		try:
+			while True:
+				pkg = yield package.read(self.stream)
+				self.last_activity = tornado.ioloop.IOLoop.instance().time()
+				if isinstance(pkg, stream_data):
+					mux_stream = self.streams.get(pkg.stream_id)
+					if mux_stream is None:
+						logging.debug('Data for unknown stream {} dropped'.format(pkg.stream_id))
+					else:
+						mux_stream.feed(payload(pkg.payload))
+						if mux_stream.buffered > self.stream_buffer:
+							yield self.pause(mux_stream)
+				elif isinstance(pkg, stream_window):
+					mux_stream = self.streams.get(pkg.stream_id)
+					if mux_stream is not None:
+						mux_stream.grant(pkg.size)
+				elif isinstance(pkg, stream_close):
+					mux_stream = self.streams.get(pkg.stream_id)
+					if mux_stream is not None:
+						mux_stream.feed(disconnect())
+						mux_stream.close()
+				elif isinstance(pkg, stream_open):
+					if self.handle_open is None or pkg.stream_id in self.streams:
+						raise Exception('Unexpected opening of stream {}'.format(pkg.stream_id))
+					mux_stream = MuxStream(self, pkg.stream_id)
+					self.streams[pkg.stream_id] = mux_stream
+					# not waited for - stream is served as long as peer keeps it open
+					self.handle_open(mux_stream, pkg)
+				else:
+					yield self.handle_package(self, pkg)
+		except tornado.iostream.StreamClosedError:
+			logging.debug('Multiplexed connection closed')
+		finally:
+			for mux_stream in list(self.streams.values()):
+				mux_stream.feed(disconnect())
+				mux_stream.close()
+			if not self.stream.closed():
+				self.stream.close()
@@ -15,12 +15,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import logging
 
 import tornado.concurrent
 import tornado.gen
 import tornado.ioloop
+import tornado.iostream
 
+import common.metrics
 import common.protocol
 
 def format_payload(payload):
@@ -36,14 +39,188 @@ def format_payload(payload):
 	s += ')'
 	return s
 
-class Proxy:
-	def __init__(self, wrapped_stream_name, wrapped_stream, raw_stream_name, raw_stream):
+# Bytes, that may be written to one side of proxy before it is flushed; until
+# then, reading from the other side goes on without waiting for writes
+DEFAULT_WRITE_WINDOW = 1024*1024
+
+# Bounds of size of single read from raw stream; it grows while reads fill it
+# completely (bulk transfer - fewer, larger frames), and shrinks back when
+# they do not (interactive traffic - small reads, sent at once)
+MIN_READ_SIZE = 16*1024
+MAX_READ_SIZE = 1024*1024
+
+# Seconds of waiting for raw stream, after which its read size goes back to
+# minimum (so that idle streams do not keep reading in large chunks)
+READ_SIZE_IDLE_RESET = 1
+
+# Bytes, that all bulk proxies together may move in single IOLoop iteration
+DEFAULT_BULK_BUDGET = 256*1024
+
+# Seconds between summaries of traffic of running proxies (totals of each
+# proxy are logged when it finishes anyway)
+DEFAULT_TRAFFIC_LOG_INTERVAL = 60
+
+# Only every that many payload is dumped at DEBUG level, in each direction
+# of each proxy; formatting every one of them slows bulk transfers down
+DEFAULT_PAYLOAD_DUMP_EVERY = 16
+payload_dump_every = DEFAULT_PAYLOAD_DUMP_EVERY
+
+class Scheduler:
+	"""Shares IOLoop between proxies of different latency classes.
+
+	Interactive proxies are never delayed. Bulk proxies may move together
+	at most bulk_budget bytes in one IOLoop iteration (or a single larger
+	frame); the rest waits (in FIFO order) for the next one, so ready
+	interactive streams are served first.
+	"""
+	def __init__(self, bulk_budget = DEFAULT_BULK_BUDGET):
+		self.bulk_budget = bulk_budget
+		self.spent = 0
+		self.waiting = collections.deque()
+		self.reset_scheduled = False
+
+	def acquire(self, latency_class, size):
+		future = tornado.concurrent.Future()
+		if latency_class != common.protocol.LATENCY_BULK:
+			future.set_result(None)
+			return future
+		if self._fits(size) and not self.waiting:
+			self.spent += size
+			future.set_result(None)
+		else:
+			self.waiting.append((future, size))
+		self._schedule_reset()
+		return future
+
+	def _fits(self, size):
+		return self.spent + size <= self.bulk_budget or self.spent == 0
+
+	def _schedule_reset(self):
+		if not self.reset_scheduled:
+			self.reset_scheduled = True
+			tornado.ioloop.IOLoop.instance().add_callback(self._next_iteration)
+
+	def _next_iteration(self):
+		self.reset_scheduled = False
+		self.spent = 0
+		while self.waiting and self._fits(self.waiting[0][1]):
+			(future, size) = self.waiting.popleft()
+			self.spent += size
+			future.set_result(None)
+		if self.spent:
+			self._schedule_reset()
+
+scheduler = Scheduler()
+
+RAW_TO_WRAPPED = 'raw_to_wrapped'
+WRAPPED_TO_RAW = 'wrapped_to_raw'
+
+bytes_counter = common.metrics.counter('proxy_bytes_total', 'payload bytes moved by proxies', ('service', 'direction'))
+frames_counter = common.metrics.counter('proxy_frames_total', 'payload frames moved by proxies', ('service', 'direction'))
+active_proxies = common.metrics.gauge('active_proxies', 'proxies currently running')
+
+running = set()
+
+def log_traffic():
+	"""Logs traffic of running proxies since previous call"""
+	for proxy in running:
+		proxy.log_traffic()
+
+class Traffic:
+	"""Payload moved by single tunnel between its wrapped stream (towards
+	the other side of NATadm) and raw one; counted into metrics, and logged
+	while the tunnel is running"""
+	def __init__(self, wrapped_stream_name, raw_stream_name, timeline = None, service = None):
 		self.wrapped_stream_name = wrapped_stream_name
-		self.wrapped_stream = wrapped_stream
 		self.raw_stream_name = raw_stream_name
+		self.timeline = timeline
+		self.raw_reads = 0
+		self.raw_bytes = 0
+		self.wrapped_frames = 0
+		self.wrapped_bytes = 0
+		self.logged = (0, 0, 0, 0)
+		self.raw_bytes_counter = bytes_counter.labels(service, RAW_TO_WRAPPED)
+		self.raw_frames_counter = frames_counter.labels(service, RAW_TO_WRAPPED)
+		self.wrapped_bytes_counter = bytes_counter.labels(service, WRAPPED_TO_RAW)
+		self.wrapped_frames_counter = frames_counter.labels(service, WRAPPED_TO_RAW)
+
+	def count_raw(self, size):
+		if self.timeline is not None:
+			self.timeline.mark('first_raw')
+		self.raw_reads += 1
+		self.raw_bytes += size
+		self.raw_bytes_counter.inc(size)
+		self.raw_frames_counter.inc()
+
+	def count_wrapped(self, size):
+		if self.timeline is not None:
+			self.timeline.mark('first_wrapped')
+		self.wrapped_frames += 1
+		self.wrapped_bytes += size
+		self.wrapped_bytes_counter.inc(size)
+		self.wrapped_frames_counter.inc()
+
+	def traffic(self):
+		return (self.raw_bytes, self.raw_reads, self.wrapped_bytes, self.wrapped_frames)
+
+	def totals_details(self):
+		return ''
+
+	def log_traffic(self, totals = False):
+		traffic = self.traffic()
+		if not totals:
+			if traffic == self.logged:
+				return
+			(traffic, self.logged) = (tuple(now - before for now, before in zip(traffic, self.logged)), traffic)
+		logging.info('{} -> {}: {} B in {} reads, {} -> {}: {} B in {} frames{}'.format(
+			self.raw_stream_name, self.wrapped_stream_name, traffic[0], traffic[1],
+			self.wrapped_stream_name, self.raw_stream_name, traffic[2], traffic[3],
+			' (total{})'.format(self.totals_details()) if totals else ''
+		))
+
+	def started(self):
+		running.add(self)
+		active_proxies.inc()
+
+	def finished(self, future = None):
+		running.discard(self)
+		active_proxies.dec()
+		self.log_traffic(totals = True)
+
+class Proxy(Traffic):
+	def __init__(self, wrapped_stream_name, wrapped_stream, raw_stream_name, raw_stream, write_window = DEFAULT_WRITE_WINDOW, latency_class = common.protocol.LATENCY_INTERACTIVE, timeline = None, service = None):
+		super(Proxy, self).__init__(wrapped_stream_name, raw_stream_name, timeline, service)
+		self.wrapped_stream = wrapped_stream
 		self.raw_stream = raw_stream
+		self.write_window = write_window
+		self.latency_class = latency_class
+		self.read_size = MIN_READ_SIZE
 		self.finish_future = tornado.concurrent.Future()
 
+	def adapt_read_size(self, size):
+		if size >= self.read_size:
+			self.read_size = min(self.read_size*2, MAX_READ_SIZE)
+		elif size < self.read_size//4:
+			self.read_size = max(self.read_size//2, MIN_READ_SIZE)
+
+	def reset_read_size(self):
+		self.read_size = MIN_READ_SIZE
+		self.raw_stream.read_chunk_size = self.read_size
+
+	def totals_details(self):
+		return ', read size {} B'.format(self.read_size)
+
+	def dump_payload(self, direction, count, payload):
+		if (count - 1) % payload_dump_every == 0 and logging.getLogger().isEnabledFor(logging.DEBUG):
+			logging.debug('{} #{}: {}'.format(direction, count, format_payload(payload)))
+
+	@tornado.gen.coroutine
+	def wait_for_window(self, stream, write_future):
+		if stream.write_buffer_size() > self.write_window:
+			yield write_future
+		elif write_future.done():
+			write_future.result()
+
 	@tornado.gen.coroutine
 	def read_wrapped(self):
 		logging.debug('Proxy.read_wrapped')
@@ -52,42 +229,71 @@ class Proxy:
 				package = yield common.protocol.package.read(self.wrapped_stream)
 				if isinstance(package, common.protocol.payload):
 					payload = package.payload
-					logging.info('{} -> {}: {} B'.format(self.wrapped_stream_name, self.raw_stream_name, len(payload)))
-					logging.debug('WRAPPED -> RAW: ' + format_payload(payload))
-					yield self.raw_stream.write(payload)
+					self.count_wrapped(len(payload))
+					self.dump_payload('WRAPPED -> RAW', self.wrapped_frames, payload)
+					yield scheduler.acquire(self.latency_class, len(payload))
+					yield self.wait_for_window(self.raw_stream, self.raw_stream.write(payload))
 				elif isinstance(package, common.protocol.disconnect):
 					logging.debug('Disconnection of tunneled client, stopping proxy')
 					self.raw_stream.close()
-					self.finish_future.set_result(True)
+					if not self.finish_future.done():
+						self.finish_future.set_result(True)
+					return
 				else:
 					raise Exception('Unexpected package received: {}'.format(package))
 		except Exception as e:
-			try:
-				yield common.protocol.disconnect().write(self.wrapped_stream)
-				self.finish_future.set_exception(e)
-			except Exception as e:
-				self.finish_future.set_exception(e)
+			yield self.finish(e)
 
 	@tornado.gen.coroutine
 	def read_raw(self):
 		logging.debug('Proxy.read_raw')
 		try:
 			while True:
-				payload = yield self.raw_stream.read_bytes(2**24, partial=True)
-				logging.info('{} -> {}: {} B'.format(self.raw_stream_name, self.wrapped_stream_name, len(payload)))
-				logging.debug('RAW -> WRAPPED: ' + format_payload(payload))
-				yield common.protocol.payload(payload).write(self.wrapped_stream)
+				# single recv() fetches at most read_chunk_size, so it
+				# bounds the frame
+				self.raw_stream.read_chunk_size = self.read_size
+				read_future = self.raw_stream.read_bytes(self.read_size, partial=True)
+				if read_future.done():
+					payload = read_future.result()
+				else:
+					io_loop = tornado.ioloop.IOLoop.instance()
+					idle = io_loop.add_timeout(io_loop.time() + READ_SIZE_IDLE_RESET, self.reset_read_size)
+					try:
+						payload = yield read_future
+					finally:
+						io_loop.remove_timeout(idle)
+				self.count_raw(len(payload))
+				self.adapt_read_size(len(payload))
+				self.dump_payload('RAW -> WRAPPED', self.raw_reads, payload)
+				yield scheduler.acquire(self.latency_class, len(payload))
+				yield self.wait_for_window(self.wrapped_stream, common.protocol.payload(payload).write(self.wrapped_stream))
 		except Exception as e:
 			if not self.raw_stream.closed():
 				self.raw_stream.close()
-			try:
-				yield common.protocol.disconnect().write(self.wrapped_stream)
-				self.finish_future.set_exception(e)
-			except Exception as e:
-				self.finish_future.set_exception(e)
+			yield self.finish(None if isinstance(e, tornado.iostream.StreamClosedError) else e)
+
+	@tornado.gen.coroutine
+	def finish(self, exception = None):
+		if self.finish_future.done():
+			return
+		try:
+			yield common.protocol.disconnect().write(self.wrapped_stream)
+		except Exception as e:
+			exception = exception or e
+		if self.finish_future.done():
+			return
+		if exception is None:
+			self.finish_future.set_result(True)
+		else:
+			self.finish_future.set_exception(exception)
 
 	def run(self):
 		logging.debug('Proxy.run')
+		if self.latency_class == common.protocol.LATENCY_INTERACTIVE:
+			self.raw_stream.set_nodelay(True)
+
+		self.started()
+		self.finish_future.add_done_callback(self.finished)
 
 		tornado.ioloop.IOLoop.instance().add_callback(self.read_wrapped)
 		tornado.ioloop.IOLoop.instance().add_callback(self.read_raw)
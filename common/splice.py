@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import fcntl
+import logging
+import os
+import socket
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+
+import common.proxy
+
+# Relaying in kernel, with data moved between sockets through a pipe, never
+# entering Python; available on Linux only
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+
+PIPE_SIZE = 1024*1024
+
+def can_splice(*streams):
+	return all(type(stream) is tornado.iostream.IOStream for stream in streams)
+
+class Direction:
+	def __init__(self, source, destination, data, count):
+		self.source = source
+		self.destination = destination
+		self.pending = data
+		self.count = count
+		if data:
+			count(len(data))
+		self.in_pipe = 0
+		self.eof = False
+		self.done = False
+		self.wait_readable = False
+		self.wait_writable = False
+		(self.pipe_r, self.pipe_w) = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+		try:
+			fcntl.fcntl(self.pipe_w, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+		except (AttributeError, OSError):
+			pass
+
+	def pump(self):
+		self.wait_readable = False
+		self.wait_writable = False
+		flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+		while not self.done:
+			try:
+				if self.pending:
+					sent = self.destination.send(self.pending)
+					self.pending = self.pending[sent:]
+				elif self.in_pipe:
+					self.in_pipe -= os.splice(self.pipe_r, self.destination.fileno(), self.in_pipe, flags=flags)
+				elif not self.eof:
+					moved = os.splice(self.source.fileno(), self.pipe_w, PIPE_SIZE, flags=flags)
+					if moved == 0:
+						self.eof = True
+					else:
+						self.count(moved)
+					self.in_pipe += moved
+				else:
+					self.destination.shutdown(socket.SHUT_WR)
+					self.done = True
+			except BlockingIOError:
+				if self.pending or self.in_pipe:
+					self.wait_writable = True
+				else:
+					self.wait_readable = True
+				return
+
+	def close(self):
+		os.close(self.pipe_r)
+		os.close(self.pipe_w)
+
+class Splice:
+	"""Relays raw bytes between two plain TCP sockets, using splice(2).
+
+	Both sockets are taken away from their streams; data already buffered
+	in a stream is sent before anything else. Each direction is shut down
+	separately, when its source reaches EOF, and run() resolves when both
+	are done. Bytes moved are counted into traffic, each splice from a
+	socket as one read (or frame).
+	"""
+	def __init__(self, wrapped_stream, raw_stream, traffic):
+		self.io_loop = tornado.ioloop.IOLoop.instance()
+		(self.socket_a, data_a) = wrapped_stream.detach()
+		(self.socket_b, data_b) = raw_stream.detach()
+		self.directions = [
+			Direction(self.socket_a, self.socket_b, data_a, traffic.count_wrapped),
+			Direction(self.socket_b, self.socket_a, data_b, traffic.count_raw),
+		]
+		self.handlers = dict()
+		self.finish_future = tornado.concurrent.Future()
+
+	def handle_events(self, fd, events):
+		try:
+			for direction in self.directions:
+				direction.pump()
+		except Exception as e:
+			self.finish(e)
+			return
+		self.update_handlers()
+
+	def update_handlers(self):
+		if all(direction.done for direction in self.directions):
+			self.finish()
+			return
+		for sock in (self.socket_a, self.socket_b):
+			events = tornado.ioloop.IOLoop.ERROR
+			for direction in self.directions:
+				if direction.wait_readable and direction.source is sock:
+					events |= tornado.ioloop.IOLoop.READ
+				if direction.wait_writable and direction.destination is sock:
+					events |= tornado.ioloop.IOLoop.WRITE
+			if sock not in self.handlers:
+				self.io_loop.add_handler(sock, self.handle_events, events)
+			elif self.handlers[sock] != events:
+				self.io_loop.update_handler(sock, events)
+			self.handlers[sock] = events
+
+	def finish(self, exception = None):
+		if self.finish_future.done():
+			return
+		for sock in self.handlers:
+			self.io_loop.remove_handler(sock)
+		self.handlers.clear()
+		for direction in self.directions:
+			direction.close()
+		self.socket_a.close()
+		self.socket_b.close()
+		if exception is None or getattr(exception, 'errno', None) in (errno.ECONNRESET, errno.EPIPE, errno.ENOTCONN):
+			self.finish_future.set_result(True)
+		else:
+			self.finish_future.set_exception(exception)
+
+	def run(self):
+		logging.debug('Splice.run')
+		self.handle_events(None, 0)
+		return self.finish_future
+
+@tornado.gen.coroutine
+def copy(source, destination, count):
+	try:
+		while True:
+			data = yield source.read_bytes(2**24, partial=True)
+			count(len(data))
+			yield destination.write(data)
+	except tornado.iostream.StreamClosedError:
+		pass
+	finally:
+		destination.close()
+
+@tornado.gen.coroutine
+def relay(wrapped_stream_name, wrapped_stream, raw_stream_name, raw_stream, timeline = None, service = None):
+	"""Relays raw bytes between two streams, until both are closed; traffic
+	is counted and logged as that of common.proxy.Proxy.
+
+	Uses Splice where possible, and plain reads and writes otherwise (TLS
+	streams, systems other than Linux); then EOF from either stream closes
+	both of them.
+	"""
+	traffic = common.proxy.Traffic(wrapped_stream_name, raw_stream_name, timeline, service)
+	traffic.started()
+	try:
+		if SPLICE_AVAILABLE and can_splice(wrapped_stream, raw_stream):
+			yield Splice(wrapped_stream, raw_stream, traffic).run()
+		else:
+			yield [
+				copy(wrapped_stream, raw_stream, traffic.count_wrapped),
+				copy(raw_stream, wrapped_stream, traffic.count_raw),
+			]
+	finally:
+		traffic.finished()
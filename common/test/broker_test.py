@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import collections
+import os
+import socket
+import unittest
+
+import tornado.gen
+import tornado.ioloop
+import tornado.testing
+
+import common.broker
+import common.utils
+
+class TestTakeFrom(unittest.TestCase):
+	def table(self):
+		return {'foo': collections.deque([1, 2, 3]), 'bar': collections.deque([4])}
+
+	def test_take_some(self):
+		table = self.table()
+		self.assertEqual([1, 2], common.broker.take_from(table, 'foo', 2))
+		self.assertEqual([3], list(table['foo']))
+		self.assertEqual([4], list(table['bar']))
+
+	def test_take_all(self):
+		table = self.table()
+		self.assertEqual([1, 2, 3], common.broker.take_from(table, 'foo'))
+		self.assertNotIn('foo', table)
+
+	def test_take_more_than_queued(self):
+		table = self.table()
+		self.assertEqual([4], common.broker.take_from(table, 'bar', 5))
+		self.assertNotIn('bar', table)
+
+	def test_take_unknown(self):
+		table = self.table()
+		self.assertEqual([], common.broker.take_from(table, 'baz', 1))
+		self.assertEqual([], common.broker.take_from(table, 'baz'))
+		self.assertEqual(['bar', 'foo'], sorted(table))
+
+class TestWithdrawFrom(unittest.TestCase):
+	def test_withdraw(self):
+		table = {'foo': collections.deque([{'worker': 0, 'id': 1}, {'worker': 1, 'id': 1}, {'worker': 0, 'id': 2}])}
+		common.broker.withdraw_from(table, 'foo', 1, 1)
+		self.assertEqual([{'worker': 0, 'id': 1}, {'worker': 0, 'id': 2}], list(table['foo']))
+		common.broker.withdraw_from(table, 'foo', 1, 1)
+		self.assertEqual(2, len(table['foo']))
+		common.broker.withdraw_from(table, 'foo', 0, 1)
+		common.broker.withdraw_from(table, 'foo', 0, 2)
+		self.assertNotIn('foo', table)
+		common.broker.withdraw_from(table, 'bar', 0, 1)
+		self.assertEqual({}, table)
+
+class TestPassSocket(tornado.testing.AsyncTestCase):
+	def get_new_ioloop(self):
+		return tornado.ioloop.IOLoop.instance()
+
+	def setUp(self):
+		super(TestPassSocket, self).setUp()
+		(self.sender, self.receiver) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sender.setblocking(False)
+		self.receiver.setblocking(False)
+		(self.passed, self.peer) = socket.socketpair()
+
+	def tearDown(self):
+		for sock in (self.sender, self.receiver, self.passed, self.peer):
+			sock.close()
+		super(TestPassSocket, self).tearDown()
+
+	@tornado.gen.coroutine
+	def check_passed(self, data, sent):
+		stream = yield common.broker.receive_stream(self.receiver)
+		if data:
+			received = yield stream.read_bytes(len(data))
+			self.assertEqual(data, received)
+		self.assertEqual(self.passed.family, stream.socket.family)
+		yield sent
+		self.peer.sendall(b'hello')
+		received = yield stream.read_bytes(5)
+		self.assertEqual(b'hello', received)
+		stream.close()
+
+	@tornado.testing.gen_test
+	def test_pass(self):
+		data = os.urandom(100)
+		yield self.check_passed(data, common.broker.pass_socket(self.sender, self.passed, data))
+
+	@tornado.testing.gen_test
+	def test_partial_send(self):
+		# message larger than buffer of Unix socket
+		data = os.urandom(4*1024*1024)
+		sent = common.broker.pass_socket(self.sender, self.passed, data)
+		self.assertFalse(sent.done())
+		yield self.check_passed(data, sent)
+
+	@tornado.testing.gen_test
+	def test_wait_writable(self):
+		filler = 0
+		try:
+			while True:
+				filler += self.sender.send(bytes(65536))
+		except BlockingIOError:
+			pass
+		sent = common.broker.pass_socket(self.sender, self.passed, b'')
+		self.assertFalse(sent.done())
+		while filler:
+			yield common.utils.wait_for_fd(self.receiver, tornado.ioloop.IOLoop.READ)
+			filler -= len(self.receiver.recv(filler))
+		yield self.check_passed(b'', sent)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import collections
+import math
+import unittest
+
+import common.metrics
+
+class TestHistogram(unittest.TestCase):
+	def histogram(self):
+		histogram = common.metrics.Histogram('test', 'test', buckets = (1, 2, 5))
+		for value in (0.5, 1, 1.5, 4, 7, 9):
+			histogram.observe(value)
+		return histogram
+
+	def test_cumulative(self):
+		histogram = self.histogram()
+		self.assertEqual([(1, 2), (2, 3), (5, 4), (float('inf'), 6)], list(histogram.cumulative()))
+		self.assertEqual(6, histogram.count)
+		self.assertEqual(23.0, histogram.sum)
+
+	def test_quantile(self):
+		histogram = self.histogram()
+		self.assertEqual(1, histogram.quantile(0.25))
+		self.assertEqual(2, histogram.quantile(0.5))
+		self.assertEqual(5, histogram.quantile(0.6))
+		self.assertEqual(float('inf'), histogram.quantile(0.99))
+
+	def test_quantile_empty(self):
+		histogram = common.metrics.Histogram('test', 'test', buckets = (1, 2, 5))
+		self.assertTrue(math.isnan(histogram.quantile(0.5)))
+		self.assertIn('p50 <= nan s', histogram.summary())
+
+class TestExposition(unittest.TestCase):
+	def test_format_value(self):
+		self.assertEqual('+Inf', common.metrics.format_value(float('inf')))
+		self.assertEqual('0.25', common.metrics.format_value(0.25))
+		self.assertEqual('3', common.metrics.format_value(3))
+
+	def test_format_labels(self):
+		self.assertEqual('', common.metrics.format_labels({}))
+		self.assertEqual('{resumed="true",le="+Inf"}', common.metrics.format_labels(collections.OrderedDict([('resumed', 'true'), ('le', float('inf'))])))
+
+	def test_format_labels_escaping(self):
+		self.assertEqual(r'{name="a\\b\"c\nd"}', common.metrics.format_labels({'name': 'a\\b"c\nd'}))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import collections
+import io
+import pickle
+import socket
+import unittest
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.testing
+
+import common.protocol
+import common.utils
+
+class TestEncodeDecodeLength(unittest.TestCase):
+	def test_encode_decode(self):
+		for original in range(1, 2**24):
+			encoded = common.protocol.package._encode_length(original)
+			decoded = common.protocol.package._decode_length(encoded)
+			self.assertEqual(original, decoded)
+
+class TestBinaryFormat(tornado.testing.AsyncTestCase):
+	@tornado.testing.gen_test
+	def test_write_read(self):
+		output = io.BytesIO()
+		writer = common.utils.FileIOStream(output)
+		common.protocol.use_binary_format(writer)
+		packages = [
+			common.protocol.hello('foo bar', common.protocol.BINARY_VERSION, common.protocol.MODE_CONTROL), common.protocol.not_interested(), common.protocol.create_tunnel(22, pending=[22, 80]),
+			common.protocol.stream_data(7, b'\x80\x00raw'), common.protocol.stream_close(7), common.protocol.stream_window(7, 100), common.protocol.payload(b''), common.protocol.error('message'),
+		]
+		for pkg in packages:
+			yield pkg.write(writer)
+
+		reader = common.utils.FileIOStream(io.BytesIO(output.getvalue()))
+		for pkg in packages:
+			read = yield common.protocol.package.read(reader)
+			self.assertIs(type(pkg), type(read))
+			self.assertEqual(pkg.__dict__, read.__dict__)
+
+	@tornado.testing.gen_test
+	def test_legacy_forbidden_class(self):
+		def legacy(obj):
+			b = pickle.dumps(obj)
+			return common.protocol.package._encode_length(len(b)) + b
+
+		with self.assertRaises(pickle.UnpicklingError):
+			yield common.protocol.package.read(legacy(collections.OrderedDict()))
+		self.assertIsInstance((yield common.protocol.package.read(legacy(common.protocol.keepalive()))), common.protocol.keepalive)
+
+class TestMultiplexer(tornado.testing.AsyncTestCase):
+	@tornado.testing.gen_test
+	def test_dispatch(self):
+		output = io.BytesIO()
+		writer = common.utils.FileIOStream(output)
+		yield common.protocol.stream_open(1, 22, ('127.0.0.1', 1234)).write(writer)
+		yield common.protocol.stream_data(1, b'foo').write(writer)
+		yield common.protocol.stream_data(2, b'unknown').write(writer)
+		yield common.protocol.stream_close(1).write(writer)
+
+		opened = []
+		@tornado.gen.coroutine
+		def handle_open(mux_stream, pkg):
+			opened.append((mux_stream, pkg))
+		multiplexer = common.protocol.Multiplexer(common.utils.FileIOStream(io.BytesIO(output.getvalue())), common.protocol.MUX_VERSION, None, handle_open)
+		yield multiplexer.run()
+
+		self.assertEqual(1, len(opened))
+		(mux_stream, pkg) = opened[0]
+		self.assertEqual(22, pkg.port)
+		self.assertEqual(b'foo', (yield common.protocol.package.read(mux_stream)).payload)
+		self.assertIsInstance((yield common.protocol.package.read(mux_stream)), common.protocol.disconnect)
+		with self.assertRaises(tornado.iostream.StreamClosedError):
+			yield common.protocol.package.read(mux_stream)
+		self.assertEqual({}, multiplexer.streams)
+
+	@tornado.testing.gen_test
+	def test_stream_buffer(self):
+		output = io.BytesIO()
+		writer = common.utils.FileIOStream(output)
+		yield common.protocol.stream_open(1, 22, ('127.0.0.1', 1234)).write(writer)
+		for i in range(8):
+			yield common.protocol.stream_data(1, b'x'*100).write(writer)
+		yield common.protocol.stream_close(1).write(writer)
+
+		opened = []
+		@tornado.gen.coroutine
+		def handle_open(mux_stream, pkg):
+			opened.append(mux_stream)
+		multiplexer = common.protocol.Multiplexer(common.utils.FileIOStream(io.BytesIO(output.getvalue())), common.protocol.MUX_VERSION, None, handle_open)
+		multiplexer.stream_buffer = 250
+		run = multiplexer.run()
+		for i in range(20):
+			yield tornado.gen.moment
+		(mux_stream,) = opened
+		self.assertTrue(multiplexer.paused)
+		self.assertEqual(300, mux_stream.buffered)
+
+		received = 0
+		while True:
+			pkg = yield common.protocol.package.read(mux_stream)
+			if isinstance(pkg, common.protocol.disconnect):
+				break
+			received += len(pkg.payload)
+			self.assertLessEqual(mux_stream.buffered, 300)
+		self.assertEqual(800, received)
+		yield run
+		self.assertFalse(multiplexer.paused)
+
+class TestFlowControl(tornado.testing.AsyncTestCase):
+	"""Multiplexers at both ends of socket pair"""
+	def get_new_ioloop(self):
+		return tornado.ioloop.IOLoop.instance()
+
+	def start(self, protocol_version):
+		(a, b) = socket.socketpair()
+		self.opened = collections.deque()
+		@tornado.gen.coroutine
+		def handle_open(mux_stream, pkg):
+			self.opened.append(mux_stream)
+		self.writer = common.protocol.Multiplexer(tornado.iostream.IOStream(a), protocol_version, None)
+		self.reader = common.protocol.Multiplexer(tornado.iostream.IOStream(b), protocol_version, None, handle_open)
+		self.runs = [self.writer.run(), self.reader.run()]
+
+	@tornado.gen.coroutine
+	def stop(self):
+		self.writer.stream.close()
+		yield self.runs
+
+	@tornado.gen.coroutine
+	def settle(self):
+		for i in range(50):
+			yield tornado.gen.Task(self.io_loop.add_callback)
+
+	@tornado.gen.coroutine
+	def read(self, mux_stream, size):
+		data = b''
+		while len(data) < size:
+			pkg = yield common.protocol.package.read(mux_stream)
+			data += pkg.payload
+		return data
+
+	@tornado.testing.gen_test
+	def test_window(self):
+		self.start(common.protocol.WINDOW_VERSION)
+		window = common.protocol.MUX_STREAM_WINDOW
+		blocked = yield self.writer.open(22, ('127.0.0.1', 1234))
+		data = bytes(range(256))*(3*window//256)
+		writes = [common.protocol.payload(data[i:i + window//4]).write(blocked) for i in range(0, len(data), window//4)]
+		yield self.settle()
+		(blocked_peer,) = self.opened
+		self.assertEqual(window, blocked_peer.buffered)
+		self.assertEqual(2*window, blocked.write_buffer_size())
+		self.assertFalse(self.reader.paused)
+
+		# other streams are not stopped by the blocked one
+		other = yield self.writer.open(80, ('127.0.0.1', 1234))
+		yield common.protocol.payload(b'other').write(other)
+		yield self.settle()
+		other_peer = self.opened[1]
+		self.assertEqual(b'other', (yield self.read(other_peer, 5)))
+
+		# waits for window too, behind the data
+		writes.append(common.protocol.disconnect().write(blocked))
+		self.assertEqual(data, (yield self.read(blocked_peer, len(data))))
+		self.assertIsInstance((yield common.protocol.package.read(blocked_peer)), common.protocol.disconnect)
+		yield writes
+		self.assertTrue(blocked.closed())
+		yield self.stop()
+
+	@tornado.testing.gen_test
+	def test_pause_timeout(self):
+		self.start(common.protocol.MUX_VERSION)
+		self.reader.stream_buffer = 250
+		self.reader.pause_timeout = 0.05
+		lagging = yield self.writer.open(22, ('127.0.0.1', 1234))
+		other = yield self.writer.open(80, ('127.0.0.1', 1234))
+		for i in range(4):
+			yield common.protocol.payload(b'x'*100).write(lagging)
+		yield common.protocol.payload(b'other').write(other)
+		yield self.settle()
+		self.assertTrue(self.reader.paused)
+		(lagging_peer, other_peer) = self.opened
+
+		self.assertEqual(b'other', (yield self.read(other_peer, 5)))
+		self.assertFalse(self.reader.paused)
+		self.assertIsInstance((yield common.protocol.package.read(lagging_peer)), common.protocol.disconnect)
+		self.assertTrue(lagging_peer.closed())
+		# the peer is told to close it too
+		self.assertIsInstance((yield common.protocol.package.read(lagging)), common.protocol.disconnect)
+		self.assertTrue(lagging.closed())
+		yield self.stop()
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import socket
+import unittest
+import unittest.mock
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.testing
+
+import common.protocol
+import common.proxy
+
+class TestAdaptReadSize(unittest.TestCase):
+	def setUp(self):
+		self.proxy = common.proxy.Proxy('wrapped', None, 'raw', unittest.mock.Mock())
+
+	def test_grow(self):
+		self.proxy.adapt_read_size(common.proxy.MIN_READ_SIZE)
+		self.assertEqual(2*common.proxy.MIN_READ_SIZE, self.proxy.read_size)
+		self.proxy.adapt_read_size(common.proxy.MIN_READ_SIZE)
+		self.assertEqual(2*common.proxy.MIN_READ_SIZE, self.proxy.read_size)
+
+	def test_shrink(self):
+		self.proxy.read_size = 8*common.proxy.MIN_READ_SIZE
+		self.proxy.adapt_read_size(2*common.proxy.MIN_READ_SIZE)
+		self.assertEqual(8*common.proxy.MIN_READ_SIZE, self.proxy.read_size)
+		self.proxy.adapt_read_size(1)
+		self.assertEqual(4*common.proxy.MIN_READ_SIZE, self.proxy.read_size)
+
+	def test_clamp(self):
+		for i in range(32):
+			self.proxy.adapt_read_size(common.proxy.MAX_READ_SIZE)
+		self.assertEqual(common.proxy.MAX_READ_SIZE, self.proxy.read_size)
+		for i in range(32):
+			self.proxy.adapt_read_size(0)
+		self.assertEqual(common.proxy.MIN_READ_SIZE, self.proxy.read_size)
+
+	def test_reset(self):
+		self.proxy.read_size = common.proxy.MAX_READ_SIZE
+		self.proxy.reset_read_size()
+		self.assertEqual(common.proxy.MIN_READ_SIZE, self.proxy.read_size)
+		self.assertEqual(common.proxy.MIN_READ_SIZE, self.proxy.raw_stream.read_chunk_size)
+
+class TestScheduler(unittest.TestCase):
+	def setUp(self):
+		patcher = unittest.mock.patch('tornado.ioloop.IOLoop.instance')
+		self.io_loop = patcher.start().return_value
+		self.addCleanup(patcher.stop)
+		self.scheduler = common.proxy.Scheduler(100)
+
+	def bulk(self, size):
+		return self.scheduler.acquire(common.protocol.LATENCY_BULK, size)
+
+	def next_iteration(self):
+		self.assertTrue(self.scheduler.reset_scheduled)
+		self.scheduler._next_iteration()
+
+	def test_budget(self):
+		futures = [self.bulk(60), self.bulk(40), self.bulk(1)]
+		self.assertEqual([True, True, False], [f.done() for f in futures])
+		self.assertEqual(1, self.io_loop.add_callback.call_count)
+
+	def test_oversized_frame(self):
+		first = self.bulk(500)
+		second = self.bulk(1)
+		self.assertTrue(first.done())
+		self.assertFalse(second.done())
+		self.next_iteration()
+		self.assertTrue(second.done())
+		third = self.bulk(500)
+		self.assertFalse(third.done())
+		self.next_iteration()
+		self.assertTrue(third.done())
+
+	def test_fifo(self):
+		self.bulk(90)
+		futures = [self.bulk(60), self.bulk(30), self.bulk(50), self.bulk(10)]
+		self.assertEqual([False, False, False, False], [f.done() for f in futures])
+		self.next_iteration()
+		self.assertEqual([True, True, False, False], [f.done() for f in futures])
+		self.next_iteration()
+		self.assertEqual([True, True, True, True], [f.done() for f in futures])
+
+	def test_interactive_bypass(self):
+		self.bulk(100)
+		waiting = self.bulk(1)
+		interactive = self.scheduler.acquire(common.protocol.LATENCY_INTERACTIVE, 1000)
+		self.assertTrue(interactive.done())
+		self.assertFalse(waiting.done())
+		self.assertEqual(100, self.scheduler.spent)
+
+	def test_budget_reset(self):
+		self.bulk(100)
+		self.next_iteration()
+		self.assertEqual(0, self.scheduler.spent)
+		self.assertFalse(self.scheduler.reset_scheduled)
+		self.assertTrue(self.bulk(100).done())
+		self.assertTrue(self.scheduler.reset_scheduled)
+		self.assertEqual(2, self.io_loop.add_callback.call_count)
+
+class TestProxy(tornado.testing.AsyncTestCase):
+	def get_new_ioloop(self):
+		return tornado.ioloop.IOLoop.instance()
+
+	def stream_pair(self):
+		(a, b) = socket.socketpair()
+		return (tornado.iostream.IOStream(a), tornado.iostream.IOStream(b))
+
+	@tornado.testing.gen_test
+	def test_idle_read_size_reset(self):
+		(wrapped, wrapped_peer) = self.stream_pair()
+		(raw, raw_peer) = self.stream_pair()
+		proxy = common.proxy.Proxy('wrapped', wrapped, 'raw', raw)
+		proxy.read_size = common.proxy.MAX_READ_SIZE
+		with unittest.mock.patch('common.proxy.READ_SIZE_IDLE_RESET', 0.05):
+			finish = proxy.run()
+			raw_peer.write(bytes(common.proxy.MIN_READ_SIZE))
+			received = 0
+			while received < common.proxy.MIN_READ_SIZE:
+				package = yield common.protocol.package.read(wrapped_peer)
+				received += len(package.payload)
+			self.assertGreater(proxy.read_size, common.proxy.MIN_READ_SIZE)
+			yield tornado.gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.1)
+			self.assertEqual(common.proxy.MIN_READ_SIZE, proxy.read_size)
+			self.assertEqual(common.proxy.MIN_READ_SIZE, raw.read_chunk_size)
+		raw_peer.close()
+		yield finish
+		wrapped_peer.close()
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import socket
+import unittest
+import unittest.mock
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.testing
+
+import common.metrics
+import common.proxy
+import common.splice
+import common.utils
+
+def stream_pair():
+	(a, b) = socket.socketpair()
+	b.setblocking(False)
+	return (tornado.iostream.IOStream(a), b)
+
+@tornado.gen.coroutine
+def receive(sock, size = None):
+	"""Data received from sock, until size bytes or EOF"""
+	data = b''
+	while size is None or len(data) < size:
+		yield common.utils.wait_for_fd(sock, tornado.ioloop.IOLoop.READ)
+		chunk = sock.recv(65536)
+		if not chunk:
+			break
+		data += chunk
+	return data
+
+class TestRelay(tornado.testing.AsyncTestCase):
+	def get_new_ioloop(self):
+		return tornado.ioloop.IOLoop.instance()
+
+	def setUp(self):
+		super(TestRelay, self).setUp()
+		(self.wrapped, self.wrapped_peer) = stream_pair()
+		(self.raw, self.raw_peer) = stream_pair()
+		self.timeline = common.metrics.Timeline()
+		self.active = common.proxy.active_proxies.labels().value
+		self.service = self.id()
+
+	def tearDown(self):
+		self.wrapped_peer.close()
+		self.raw_peer.close()
+		super(TestRelay, self).tearDown()
+
+	def start(self):
+		self.relay = common.splice.relay('wrapped', self.wrapped, 'raw', self.raw, self.timeline, self.service)
+		self.assertEqual(self.active + 1, common.proxy.active_proxies.labels().value)
+
+	def counted(self, direction):
+		return (
+			common.proxy.bytes_counter.labels(self.service, direction).value,
+			common.proxy.frames_counter.labels(self.service, direction).value,
+		)
+
+	@tornado.gen.coroutine
+	def check_finished(self, raw_bytes, wrapped_bytes):
+		yield self.relay
+		self.assertEqual(self.active, common.proxy.active_proxies.labels().value)
+		self.assertEqual({'first_raw', 'first_wrapped'}, self.timeline.marked)
+		self.assertEqual(raw_bytes, self.counted(common.proxy.RAW_TO_WRAPPED)[0])
+		self.assertEqual(wrapped_bytes, self.counted(common.proxy.WRAPPED_TO_RAW)[0])
+		self.assertGreater(self.counted(common.proxy.RAW_TO_WRAPPED)[1], 0)
+		self.assertGreater(self.counted(common.proxy.WRAPPED_TO_RAW)[1], 0)
+
+	@tornado.gen.coroutine
+	def half_close(self, first_peer, second_peer):
+		first_peer.sendall(b'request')
+		first_peer.shutdown(socket.SHUT_WR)
+		data = yield receive(second_peer)
+		self.assertEqual(b'request', data)
+		# the other direction still works
+		second_peer.sendall(b'response')
+		second_peer.shutdown(socket.SHUT_WR)
+		data = yield receive(first_peer)
+		self.assertEqual(b'response', data)
+
+	@unittest.skipUnless(common.splice.SPLICE_AVAILABLE, 'splice(2) unavailable')
+	@tornado.testing.gen_test
+	def test_half_close_wrapped(self):
+		self.start()
+		yield self.half_close(self.wrapped_peer, self.raw_peer)
+		yield self.check_finished(len(b'response'), len(b'request'))
+
+	@unittest.skipUnless(common.splice.SPLICE_AVAILABLE, 'splice(2) unavailable')
+	@tornado.testing.gen_test
+	def test_half_close_raw(self):
+		self.start()
+		yield self.half_close(self.raw_peer, self.wrapped_peer)
+		yield self.check_finished(len(b'request'), len(b'response'))
+
+	@tornado.testing.gen_test
+	def test_copy(self):
+		with unittest.mock.patch('common.splice.SPLICE_AVAILABLE', False):
+			self.start()
+		self.raw_peer.sendall(b'response')
+		data = yield receive(self.wrapped_peer, len(b'response'))
+		self.assertEqual(b'response', data)
+		# EOF closes both streams
+		self.wrapped_peer.sendall(b'request')
+		self.wrapped_peer.shutdown(socket.SHUT_WR)
+		data = yield receive(self.raw_peer)
+		self.assertEqual(b'request', data)
+		data = yield receive(self.wrapped_peer)
+		self.assertEqual(b'', data)
+		yield self.check_finished(len(b'response'), len(b'request'))
+
+if __name__ == '__main__':
+	unittest.main()
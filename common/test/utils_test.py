@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 Mariusz Pluciński
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import common.utils
+
+class TestSSLOptions(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.paths = []
+		for name in ('cert.pem', 'key.pem', 'ca.pem'):
+			path = os.path.join(self.directory, name)
+			with open(path, 'w') as f:
+				f.write(name)
+			self.paths.append(path)
+		common.utils._contexts.clear()
+		self.create_ssl_context = common.utils.create_ssl_context
+		# contexts are told apart by identity; parsing real certificates is
+		# what create_ssl_context does, and is not tested here
+		patcher = unittest.mock.patch('common.utils.create_ssl_context', side_effect=lambda *args: object())
+		self.create = patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def tearDown(self):
+		common.utils._contexts.clear()
+		shutil.rmtree(self.directory)
+
+	def test_cached(self):
+		context = common.utils.ssl_options(*self.paths)
+		self.assertIs(context, common.utils.ssl_options(*self.paths))
+		self.assertEqual(1, self.create.call_count)
+		self.assertIsNot(context, common.utils.ssl_options(*self.paths, resume_sessions=True))
+		self.assertEqual(2, self.create.call_count)
+
+	def test_certificate_changed(self):
+		context = common.utils.ssl_options(*self.paths)
+		stat = os.stat(self.paths[0])
+		os.utime(self.paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+		new_context = common.utils.ssl_options(*self.paths)
+		self.assertIsNot(context, new_context)
+		self.assertIs(new_context, common.utils.ssl_options(*self.paths))
+		self.assertEqual(2, self.create.call_count)
+
+	def test_missing_file(self):
+		self.create.side_effect = self.create_ssl_context
+		os.remove(self.paths[1])
+		with self.assertRaises(Exception):
+			common.utils.ssl_options(*self.paths)
+		self.assertEqual({}, common.utils._contexts)
+		with self.assertRaises(Exception):
+			common.utils.ssl_options(*self.paths)
+		self.assertEqual(2, self.create.call_count)
+
+if __name__ == '__main__':
+	unittest.main()
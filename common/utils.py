@@ -18,13 +18,49 @@
 import inspect
 import io
 import logging
+import os
 import ssl
 
+import tornado.concurrent
+import tornado.ioloop
 import tornado.iostream
 import tornado.netutil
 
-def ssl_options(certfile, keyfile, cacerts):
-	context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+class ResumingContext(ssl.SSLContext):
+	"""Client context, which resumes the last remembered TLS session in each
+	connection, so that it costs abbreviated handshake only"""
+	session = None
+
+	def wrap_socket(self, *args, **kwargs):
+		if self.session is not None:
+			kwargs.setdefault('session', self.session)
+		return super(ResumingContext, self).wrap_socket(*args, **kwargs)
+
+	def remember_session(self, sock):
+		# with TLS 1.3, session (ticket) arrives after handshake, so this
+		# should be called after something was read from the server
+		if sock.session is not None:
+			self.session = sock.session
+
+# (certfile, keyfile, cacerts, resume_sessions) -> (modification times of files, context)
+_contexts = dict()
+
+def ssl_options(certfile, keyfile, cacerts, resume_sessions = False):
+	"""Context for given files; parsing them is costly, so it is built
+	again only when any of them was modified (e.g. certificate rotated)"""
+	key = (certfile, keyfile, cacerts, resume_sessions)
+	mtimes = tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in (certfile, keyfile, cacerts))
+	cached = _contexts.get(key)
+	if cached is not None and cached[0] == mtimes:
+		return cached[1]
+	if cached is not None:
+		logging.info('Certificates changed, reloading (certfile: {!r}, keyfile: {!r}, cacerts: {!r})'.format(certfile, keyfile, cacerts))
+	context = create_ssl_context(certfile, keyfile, cacerts, resume_sessions)
+	_contexts[key] = (mtimes, context)
+	return context
+
+def create_ssl_context(certfile, keyfile, cacerts, resume_sessions = False):
+	context = (ResumingContext if resume_sessions else ssl.SSLContext)(ssl.PROTOCOL_SSLv23)
 	context.options |= ssl.OP_NO_SSLv2
 	context.options |= ssl.OP_NO_SSLv3
 	try:
@@ -37,6 +73,56 @@ def ssl_options(certfile, keyfile, cacerts):
 	except Exception as e:
 		raise Exception('Could not verify locations of certificates: {!r}'.format(cacerts)) from e
 	context.verify_flags = ssl.VERIFY_CRL_CHECK_CHAIN
+	return context
+
+def wait_for_fd(fd, events):
+	"""Future resolved when fd (or socket) is ready for IOLoop events"""
+	future = tornado.concurrent.Future()
+	io_loop = tornado.ioloop.IOLoop.instance()
+	def ready(fd, events):
+		io_loop.remove_handler(fd)
+		future.set_result(events)
+	io_loop.add_handler(fd, ready, events | tornado.ioloop.IOLoop.ERROR)
+	return future
+
+class CloseWatcher:
+	"""Calls callback, when peer closes socket of stream, which is waiting
+	(not read) for something else. Data received meanwhile are kept, up to
+	limit bytes (then watching ends), and given back to stream by stop()."""
+	def __init__(self, stream, callback, limit = 64*1024):
+		self.stream = stream
+		self.callback = callback
+		self.limit = limit
+		self.data = bytearray()
+		self.watching = True
+		tornado.ioloop.IOLoop.instance().add_handler(stream.fileno(), self.handle_events, tornado.ioloop.IOLoop.READ)
+
+	def handle_events(self, fd, events):
+		try:
+			data = self.stream.socket.recv(self.limit - len(self.data))
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			data = b''
+		if not data:
+			self.remove_handler()
+			self.stream.close()
+			self.callback()
+			return
+		self.data += data
+		if len(self.data) >= self.limit:
+			self.remove_handler()
+
+	def remove_handler(self):
+		if self.watching:
+			tornado.ioloop.IOLoop.instance().remove_handler(self.stream.fileno())
+			self.watching = False
+
+	def stop(self):
+		"""Stops watching, before stream is used"""
+		self.remove_handler()
+		self.stream.unread(bytes(self.data))
+		self.data = bytearray()
 
 class FileIOStream(tornado.iostream.BaseIOStream):
 	def __init__(self, file, *args, **kwargs):
@@ -57,13 +143,13 @@ class FileIOStream(tornado.iostream.BaseIOStream):
 		logging.debug('FileIOStream.write_to_fd')
 		return self.file.write(data)
 
-	def read_from_fd(self):
+	def read_from_fd(self, buf):
 		logging.debug('FileIOStream.read_from_fd')
-		chunk = self.file.read(self.read_chunk_size)
-		if not chunk:
+		bytes_read = self.file.readinto(buf)
+		if not bytes_read:
 			self.close()
 			return None
-		return chunk
+		return bytes_read
 
 def reformat_logger(prefix):
 	import tornado.log
@@ -15,26 +15,39 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import atexit
 import collections
 import logging
 import os.path
 import shlex
+import shutil
 import ssl
 import sys
 import tempfile
+import time
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 os.chdir(current_dir)
 sys.path.insert(0, os.path.dirname(current_dir))
 
+import tornado.concurrent
 import tornado.gen
+import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.tcpclient
 import tornado.tcpserver
+import tornado.web
 
+import common.broker
+import common.handshake
+import common.metrics
 import common.protocol
 import common.proxy
+import common.splice
 import common.utils
 
 CONFIG_FILE = 'NATadm_server.conf'
@@ -48,8 +61,20 @@ common.utils.reformat_logger('SERVER')
 tornado.options.define('communication_port', type=int)
 tornado.options.define('communication_server_certificate', type=tuple)
 tornado.options.define('communication_client_ca', type=str)
+tornado.options.define('communication_plaintext', type=bool, default=False)
 
 tornado.options.define('services', type=dict)
+tornado.options.define('proxy_write_window', type=int, default=common.proxy.DEFAULT_WRITE_WINDOW)
+tornado.options.define('bulk_budget', type=int, default=common.proxy.DEFAULT_BULK_BUDGET)
+tornado.options.define('splice', type=bool, default=False)
+tornado.options.define('metrics_interval', type=int, default=600)
+tornado.options.define('traffic_log_interval', type=int, default=common.proxy.DEFAULT_TRAFFIC_LOG_INTERVAL)
+tornado.options.define('payload_dump_every', type=int, default=common.proxy.DEFAULT_PAYLOAD_DUMP_EVERY)
+tornado.options.define('metrics_port', type=int, default=None)
+tornado.options.define('metrics_address', type=str, default='127.0.0.1')
+tornado.options.define('workers', type=int, default=1)
+tornado.options.define('handshake_threads', type=int, default=0)
+tornado.options.define('max_standby_connections', type=int, default=4)
 
 tornado.options.define('config_file', type=str)
 
@@ -64,50 +89,314 @@ if len(config_file) != 0:
 
 tornado.options.options.run_parse_callbacks()
 
+common.proxy.scheduler.bulk_budget = tornado.options.options.bulk_budget
+common.proxy.payload_dump_every = max(1, tornado.options.options.payload_dump_every)
+
+# Seconds between checks, whether certificates were changed on disk
+CERTIFICATES_CHECK_INTERVAL = 60
+
 COMMAND_WAITFOR = 'WAITFOR'
 COMMAND_NOWAIT = 'NOWAIT'
 COMMAND_EXIT = 'EXIT'
 COMMAND_KILL = 'KILL'
 
+handshakes = common.metrics.counter('handshakes_total', 'hellos received from clients, by mode', ('mode',))
+handshake_errors = common.metrics.counter('handshake_errors_total', 'connections of clients closed or failed before hello')
+tls_handshakes = common.metrics.counter('tls_handshakes_total', 'TLS handshakes with clients, by resumption of session', ('resumed',))
+handshake_histogram = common.metrics.histogram('handshake_seconds', 'time from connection of client until its hello (including TLS handshake)')
+
 class Server(tornado.tcpserver.TCPServer):
 	def __init__(self, *args, **kwargs):
 		super(Server, self).__init__(*args, **kwargs)
 		self.requests_table = dict()
+		self.control_channels = dict()
+		# client name -> futures of its parked standby connections, resolved
+		# with True when a user is bound to one, False when it closes
+		self.standby = dict()
+		# set in worker processes, when there are several of them
+		self.broker = None
+		# set when TLS handshakes run in threads, instead of in the IOLoop
+		self.handshake_pool = None
+
+	@tornado.gen.coroutine
+	def accept_user(self, name, client_port, server_port):
+		if isinstance(server_port, WaitingUser):
+			logging.info('Client \"{}\" will forward it\'s port {} to awaiting connection'.format(name, client_port))
+			return (yield server_port.accept())
+		elif isinstance(server_port, common.broker.RemoteUser):
+			logging.info('Client \"{}\" will forward it\'s port {} to user waiting in worker {}'.format(name, client_port, server_port.worker))
+			return (yield server_port.accept())
+		else:
+			logging.info('Client \"{}\" will forward it\'s port {} to local {}'.format(name, client_port, server_port))
+			forward = ForwardServer(self)
+			forward.listen(server_port)
+			logging.info('Waiting for connections on {}'.format(server_port))
+			return (yield forward.accept())
+
+	@tornado.gen.coroutine
+	def add_request(self, name, client_port, server_port, stream, address):
+		if self.broker is not None:
+			yield self.broker.add_request(name, client_port, server_port.latency_class, stream, address)
+			return
+		timeline = common.metrics.Timeline()
+		user = WaitingUser(stream, address, server_port.latency_class, lambda: self.user_left(name, user))
+		self.requests_table.setdefault(name, collections.deque()).append((client_port, user, address, timeline))
+		timeline.mark('queued')
+		yield self.notify_client(name)
+
+	def user_left(self, name, user):
+		queue = self.requests_table.get(name, ())
+		for request in queue:
+			if request[1] is user:
+				logging.info('User {} disconnected before client \"{}\" came'.format(user.address, name))
+				queue.remove(request)
+				break
+		if not queue:
+			self.requests_table.pop(name, None)
+
+	@tornado.gen.coroutine
+	def take_requests(self, name, count = None):
+		"""Up to count (all, if None) oldest pending requests for client,
+		removed from requests table, and ports of requests left in it"""
+		if self.broker is not None:
+			(requests, pending) = yield self.broker.take_requests(name, count)
+		else:
+			requests = common.broker.take_from(self.requests_table, name, count)
+			pending = [request[0] for request in self.requests_table.get(name, ())]
+		for (client_port, server_port, address, timeline) in requests:
+			logging.debug('Request of {} for client \"{}\" waited {:.3f} s'.format(address, name, time.monotonic() - timeline.start))
+		return (requests, pending)
+
+	def standby_connections(self):
+		return sum(len(parked) for parked in self.standby.values())
+
+	def pending_requests(self):
+		return sum(len(queue) for queue in self.requests_table.values()) + (len(self.broker.users) if self.broker is not None else 0)
+
+	@staticmethod
+	def latency_class(server_port):
+		if isinstance(server_port, (ForwardServer, WaitingUser, common.broker.RemoteUser)):
+			return server_port.latency_class
+		return common.protocol.LATENCY_INTERACTIVE
+
+	@staticmethod
+	def can_relay(stream, protocol_version):
+		return (tornado.options.options.splice
+			and protocol_version >= common.protocol.RELAY_VERSION
+			and common.splice.can_splice(stream))
+
+	@classmethod
+	def carries_tunnels(cls, channel):
+		return channel.protocol_version >= common.protocol.MUX_VERSION and not cls.can_relay(channel.stream, channel.protocol_version)
+
+	def wake_standby(self, name):
+		"""Binds oldest pending request to standby connection of client;
+		False if it has none parked"""
+		parked = self.standby.get(name)
+		if not parked:
+			return False
+		parked.popleft().set_result(True)
+		if not parked:
+			del self.standby[name]
+		return True
+
+	@tornado.gen.coroutine
+	def notify_client(self, name):
+		channel = self.control_channels.get(name)
+		if channel is not None and self.carries_tunnels(channel):
+			# not waited for - tunnels live as long as their proxies
+			self.tunnel_over_channel(name, channel)
+			return
+		if self.wake_standby(name):
+			logging.info('Client \"{}\" has standby connection, using it'.format(name))
+			return
+		if channel is None:
+			logging.debug('Client \"{}\" has no control channel, waiting for its poll'.format(name))
+			return
+		logging.info('Waking up client \"{}\"'.format(name))
+		try:
+			yield common.protocol.wakeup().write(channel.stream)
+		except Exception as e:
+			logging.warning('Could not wake up client \"{}\": {}'.format(name, e))
+
+	@tornado.gen.coroutine
+	def tunnel_over_channel(self, name, channel):
+		# all users waiting for the client get their streams at once
+		requests = (yield self.take_requests(name))[0]
+		for request in requests:
+			self.mux_tunnel(name, channel, request)
+
+	@tornado.gen.coroutine
+	def mux_tunnel(self, name, channel, request):
+		(client_port, server_port, orig_client_address, timeline) = request
+		timeline.mark('client_reached')
+		latency_class = self.latency_class(server_port)
+		server_stream = None
+		try:
+			(server_stream, server_address) = yield self.accept_user(name, client_port, server_port)
+			logging.info('Incoming connection to be tunneled from {}'.format(server_address))
+			mux_stream = yield channel.open(client_port, orig_client_address, latency_class)
+			timeline.mark('tunnel_requested')
+
+			proxy = common.proxy.Proxy('NATadm:{}:{}#{}'.format(name, client_port, mux_stream.stream_id), mux_stream, orig_client_address, server_stream, tornado.options.options.proxy_write_window, latency_class, timeline, '{}:{}'.format(name, client_port))
+			yield proxy.run()
+		except Exception as e:
+			logging.exception(e)
+		finally:
+			if server_stream is not None and not server_stream.closed():
+				server_stream.close()
+
+	@tornado.gen.coroutine
+	def handle_control_package(self, channel, package):
+		if isinstance(package, common.protocol.keepalive):
+			yield channel.write(common.protocol.keepalive())
+		else:
+			raise Exception('Unexpected package received on control channel: {}'.format(package))
+
+	@tornado.gen.coroutine
+	def handle_control_channel(self, stream, hello):
+		protocol_version = hello.negotiate_protocol_version()
+		if protocol_version >= common.protocol.BINARY_VERSION:
+			common.protocol.use_binary_format(stream)
+		yield common.protocol.hello(hello.name, protocol_version, common.protocol.MODE_CONTROL).write(stream)
+
+		channel = common.protocol.Multiplexer(stream, protocol_version, self.handle_control_package)
+		previous = self.control_channels.get(hello.name)
+		if previous is not None:
+			logging.info('Client \"{}\" reopened control channel, closing previous one'.format(hello.name))
+			previous.stream.close()
+		self.control_channels[hello.name] = channel
+		logging.info('Client \"{}\" opened control channel (protocol version: {})'.format(hello.name, protocol_version))
+
+		try:
+			if self.broker is not None:
+				# broker notifies back, if there are requests for the client
+				yield self.broker.channel_opened(hello.name, self.carries_tunnels(channel))
+			elif hello.name in self.requests_table:
+				yield self.notify_client(hello.name)
+			yield channel.run()
+			logging.info('Client \"{}\" closed control channel'.format(hello.name))
+		finally:
+			if self.control_channels.get(hello.name) is channel:
+				del self.control_channels[hello.name]
+				if self.broker is not None:
+					self.broker.channel_closed(hello.name)
+
+	@tornado.gen.coroutine
+	def handle_standby(self, stream, hello):
+		"""Parks connection of client until a user connects (then answers it
+		as a poll), or until client closes it"""
+		protocol_version = hello.negotiate_protocol_version()
+		if protocol_version < common.protocol.STANDBY_VERSION:
+			raise Exception('Too old protocol version for standby connection: {}'.format(protocol_version))
+		if len(self.standby.get(hello.name, ())) >= tornado.options.options.max_standby_connections:
+			raise Exception('Too many standby connections of client \"{}\"'.format(hello.name))
+		if protocol_version >= common.protocol.BINARY_VERSION:
+			common.protocol.use_binary_format(stream)
+		yield common.protocol.hello(hello.name, protocol_version, common.protocol.MODE_STANDBY).write(stream)
+
+		# future is parked as long as it is not resolved
+		future = tornado.concurrent.Future()
+		self.standby.setdefault(hello.name, collections.deque()).append(future)
+		def closed():
+			if not future.done():
+				self.standby[hello.name].remove(future)
+				if not self.standby[hello.name]:
+					del self.standby[hello.name]
+				future.set_result(False)
+		stream.set_close_callback(closed)
+		logging.debug('Client \"{}\" parked standby connection'.format(hello.name))
+		if self.broker is not None:
+			# broker notifies back, if there are requests for the client
+			yield self.broker.standby_parked(hello.name)
+		elif hello.name in self.requests_table:
+			self.wake_standby(hello.name)
+		try:
+			while True:
+				try:
+					bound = yield tornado.gen.with_timeout(tornado.ioloop.IOLoop.instance().time() + common.protocol.STANDBY_KEEPALIVE_INTERVAL, future)
+					break
+				except tornado.gen.TimeoutError:
+					try:
+						yield common.protocol.keepalive().write(stream)
+					except tornado.iostream.StreamClosedError:
+						pass
+		finally:
+			if self.broker is not None:
+				self.broker.standby_unparked(hello.name)
+		if not bound:
+			logging.debug('Client \"{}\" closed standby connection'.format(hello.name))
+			return
+		stream.set_close_callback(None)
+		if stream.closed():
+			# closed just after being bound; request goes to another connection
+			yield self.notify_client(hello.name)
+			return
+		yield self.serve_poll(stream, hello.name, protocol_version)
+
+	@tornado.gen.coroutine
+	def serve_poll(self, stream, name, protocol_version):
+		# single tunnel per connection; client polls for the pending ones at once
+		(requests, pending) = yield self.take_requests(name, 1)
+		if requests:
+			(client_port, server_port, orig_client_address, timeline) = requests[0]
+			timeline.mark('client_reached')
+			latency_class = self.latency_class(server_port)
+			relay = self.can_relay(stream, protocol_version)
+			if pending:
+				logging.info('Client "{}" has {} more pending requests'.format(name, len(pending)))
+			yield common.protocol.create_tunnel(client_port, latency_class, relay, pending).write(stream)
+			timeline.mark('tunnel_requested')
+			(server_stream, server_address) = yield self.accept_user(name, client_port, server_port)
+			logging.info('Incoming connection to be tunneled from {}'.format(server_address))
+			yield common.protocol.connect(orig_client_address).write(stream)
+			timeline.mark('connect_sent')
+
+			if relay:
+				logging.info('Relaying raw bytes between {} and client "{}"'.format(orig_client_address, name))
+				yield common.splice.relay('NATadm:{}:{}'.format(name, client_port), stream, orig_client_address, server_stream, timeline, '{}:{}'.format(name, client_port))
+				return
+
+			proxy = common.proxy.Proxy('NATadm:{}:{}'.format(name, client_port), stream, orig_client_address, server_stream, tornado.options.options.proxy_write_window, latency_class, timeline, '{}:{}'.format(name, client_port))
+			yield proxy.run()
+
+		else:
+			logging.info('Client "{}" connected, but no pending requests for it - disconnecting'.format(name))
+			yield common.protocol.not_interested().write(stream)
 
 	@tornado.gen.coroutine
 	def handle_stream(self, stream, address):
 		try:
 			logging.debug('Client connected')
-			package = yield common.protocol.package.read(stream)
+			start = time.monotonic()
+			try:
+				if self.handshake_pool is not None:
+					stream = yield self.handshake_pool.handshake(stream)
+				package = yield common.protocol.package.read(stream)
+			except Exception:
+				handshake_errors.inc()
+				raise
 			if not isinstance(package, common.protocol.hello):
+				handshake_errors.inc()
 				raise Exception('Invalid package received, HELLO expected')
+			handshake_histogram.observe(time.monotonic() - start)
+			handshakes.labels(package.mode).inc()
+			if isinstance(stream, tornado.iostream.SSLIOStream):
+				tls_handshakes.labels('true' if stream.socket.session_reused else 'false').inc()
+
+			if package.mode == common.protocol.MODE_CONTROL:
+				yield self.handle_control_channel(stream, package)
+				return
+			if package.mode == common.protocol.MODE_STANDBY:
+				yield self.handle_standby(stream, package)
+				return
 
 			package.check_protocol_version()
+			if package.protocol_version >= common.protocol.BINARY_VERSION:
+				common.protocol.use_binary_format(stream)
 
 			logging.debug('Client name: \"{}\"'.format(package.name))
-			if package.name in self.requests_table:
-				(client_port, server_port, orig_client_address) = self.requests_table[package.name]
-				del self.requests_table[package.name]
-				yield common.protocol.create_tunnel(client_port).write(stream)
-				if isinstance(server_port, ForwardServer):
-					logging.info('Client \"{}\" will forward it\'s port {} to awaiting connection'.format(package.name, client_port))
-					server_stream = server_port.awaiting_stream
-					server_address = server_port.awaiting_address
-				else:
-					logging.info('Client \"{}\" will forward it\'s port {} to local {}'.format(package.name, client_port, server_port))
-					forward = ForwardServer(self)
-					forward.listen(server_port)
-					logging.info('Waiting for connections on {}'.format(server_port))
-					(server_stream, server_address) = yield forward.accept()
-				logging.info('Incoming connection to be tunneled from {}'.format(server_address))
-				yield common.protocol.connect(orig_client_address).write(stream)
-
-				proxy = common.proxy.Proxy('NATadm:{}:{}'.format(package.name, client_port), stream, orig_client_address, server_stream)
-				yield proxy.run()
-
-			else:
-				logging.info('Client "{}" connected, but no pending requests for it - disconnecting'.format(package.name))
-				yield common.protocol.not_interested().write(stream)
+			yield self.serve_poll(stream, package.name, package.protocol_version)
 		except Exception as e:
 			logging.exception(e)
 			if not stream.closed():
@@ -116,6 +405,20 @@ class Server(tornado.tcpserver.TCPServer):
 			if not stream.closed():
 				stream.close()
 
+class WaitingUser:
+	"""User accepted by ForwardServer, waiting in requests table for its
+	client; left is called if the user disconnects meanwhile"""
+	def __init__(self, stream, address, latency_class, left):
+		self.stream = stream
+		self.address = address
+		self.latency_class = latency_class
+		self.watcher = common.utils.CloseWatcher(stream, left)
+
+	@tornado.gen.coroutine
+	def accept(self):
+		self.watcher.stop()
+		return (self.stream, self.address)
+
 class ForwardServer(tornado.tcpserver.TCPServer):
 	def __init__(self, server, *args, **kwargs):
 		super(ForwardServer, self).__init__(*args, **kwargs)
@@ -123,13 +426,13 @@ class ForwardServer(tornado.tcpserver.TCPServer):
 		self.accept_future = tornado.concurrent.Future()
 		self.target_client = None
 		self.target_port = None
-		self.awaiting_stream = None
-		self.awaiting_address = None
+		self.latency_class = common.protocol.LATENCY_INTERACTIVE
 
 	@tornado.gen.coroutine
-	def set_permanent_service(self, client, port):
+	def set_permanent_service(self, client, port, latency_class = common.protocol.LATENCY_INTERACTIVE):
 		self.target_client = client
 		self.target_port = port
+		self.latency_class = latency_class
 
 	def accept(self):
 		return self.accept_future
@@ -143,9 +446,7 @@ class ForwardServer(tornado.tcpserver.TCPServer):
 			logging.info('User connected from {}, will forward to {}:{}'.format(
 				address, self.target_client, self.target_port
 			))
-			self.server.requests_table[self.target_client] = (self.target_port, self, address)
-			self.awaiting_stream = stream
-			self.awaiting_address = address
+			yield self.server.add_request(self.target_client, self.target_port, self, stream, address)
 
 #class ControlServer(tornado.tcpserver.TCPServer):
 #	def __init__(self, server, *args, **kwargs):
@@ -204,17 +505,95 @@ class ForwardServer(tornado.tcpserver.TCPServer):
 #			if not stream.closed():
 #				stream.close()
 
+class MetricsHandler(tornado.web.RequestHandler):
+	def get(self):
+		self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.write(common.metrics.exposition())
+
+def listen(tcp_server, port, reuse_port):
+	tcp_server.add_sockets(tornado.netutil.bind_sockets(port, reuse_port=reuse_port))
+
+def fork_workers(workers):
+	"""Forks workers, sharing listening ports with SO_REUSEPORT, and the
+	broker; returns (number of worker, directory of rendezvous sockets) in
+	workers, does not return in the broker"""
+	directory = tempfile.mkdtemp(prefix='NATadm_server-')
+	master_pid = os.getpid()
+	atexit.register(lambda: os.getpid() == master_pid and shutil.rmtree(directory, ignore_errors=True))
+	# bound before forking, so workers may connect to it at once
+	broker_socket = tornado.netutil.bind_unix_socket(os.path.join(directory, common.broker.BROKER_SOCKET))
+	logging.info('Starting {} workers'.format(workers))
+	worker = tornado.process.fork_processes(workers + 1)
+	if worker == workers:
+		logging.info('Broker started')
+		broker = common.broker.Broker()
+		broker.add_socket(broker_socket)
+		tornado.ioloop.IOLoop.instance().start()
+		sys.exit(0)
+	broker_socket.close()
+	logging.info('Worker {} started'.format(worker))
+	return (worker, directory)
+
+def communication_ssl_options():
+	return common.utils.ssl_options(
+		certfile=tornado.options.options.communication_server_certificate[0],
+		keyfile=tornado.options.options.communication_server_certificate[1],
+		cacerts=tornado.options.options.communication_client_ca
+	)
+
+def reload_certificates(server):
+	"""Makes new connections use rotated certificates; context is cached,
+	so this is cheap when nothing changed"""
+	try:
+		ssl_options = communication_ssl_options()
+	except Exception as e:
+		logging.warning('Could not reload certificates, keeping previous ones: {}'.format(e))
+		return
+	if server.handshake_pool is not None:
+		server.handshake_pool.ssl_options = ssl_options
+	else:
+		server.ssl_options = ssl_options
+
+def listen_metrics(server, port):
+	common.metrics.gauge('connected_clients', 'clients with open control channel', function=lambda: len(server.control_channels))
+	common.metrics.gauge('pending_requests', 'requests waiting for their clients', function=server.pending_requests)
+	common.metrics.gauge('standby_connections', 'connections parked by clients for next users', function=server.standby_connections)
+	common.metrics.LoopLagMonitor().start()
+
+	application = tornado.web.Application([(r'/metrics', MetricsHandler)])
+	http_server = tornado.httpserver.HTTPServer(application)
+	http_server.listen(port, tornado.options.options.metrics_address)
+	logging.info('Serving metrics on http://{}:{}/metrics'.format(tornado.options.options.metrics_address, port))
+
 def main():
 	logging.info('=== NATadm server (protocol version: {}) ==='.format(common.protocol.MAX_VERSION))
+	plaintext = tornado.options.options.communication_plaintext
+	if plaintext:
+		logging.warning('Connections with clients are not encrypted nor authenticated; use on trusted networks only')
+		ssl_options = None
+	else:
+		if tornado.options.options.splice:
+			logging.warning('Splice relays plaintext connections only; it is unused without communication_plaintext')
+		# created before forking, so that all workers share keys of session
+		# tickets, and resume sessions started with each other
+		ssl_options = communication_ssl_options()
+	workers = tornado.options.options.workers or tornado.process.cpu_count()
+	worker = None
+	if workers > 1:
+		(worker, directory) = fork_workers(workers)
 	io_loop = tornado.ioloop.IOLoop.instance()
 
-	server = Server(ssl_options=common.utils.ssl_options(
-		certfile=tornado.options.options.communication_server_certificate[0],
-		keyfile=tornado.options.options.communication_server_certificate[1],
-		cacerts=tornado.options.options.communication_client_ca
-	))
+	if tornado.options.options.handshake_threads and not plaintext:
+		# server accepts plain streams, handshake is done by the pool
+		server = Server()
+		server.handshake_pool = common.handshake.HandshakePool(ssl_options, tornado.options.options.handshake_threads)
+	else:
+		server = Server(ssl_options=ssl_options)
+	if worker is not None:
+		server.broker = common.broker.BrokerClient(directory, worker, server.notify_client)
+		io_loop.run_sync(server.broker.start)
 	logging.info('Listening on port {} ...'.format(tornado.options.options.communication_port))
-	server.listen(tornado.options.options.communication_port)
+	listen(server, tornado.options.options.communication_port, worker is not None)
 
 #	control_server = ControlServer(server, ssl_options=common.utils.ssl_options(
 #		certfile=tornado.options.options.control_server_certificate[0],
@@ -230,13 +609,29 @@ def main():
 #	)
 
 	for port, service in tornado.options.options.services.items():
-		logging.info('Listening on port {} for connections to forward to {}:{}'.format(port, service['client'], service['port']))
+		latency_class = service.get('class', common.protocol.LATENCY_INTERACTIVE)
+		if latency_class not in (common.protocol.LATENCY_INTERACTIVE, common.protocol.LATENCY_BULK):
+			raise Exception('Unknown latency class of service on port {}: {!r}'.format(port, latency_class))
+		logging.info('Listening on port {} for connections to forward to {}:{} ({})'.format(port, service['client'], service['port'], latency_class))
 
 		forward_server = ForwardServer(server)
-		forward_server.set_permanent_service(service['client'], service['port'])
-		forward_server.listen(port)
+		forward_server.set_permanent_service(service['client'], service['port'], latency_class)
+		listen(forward_server, port, worker is not None)
+
+	if not plaintext:
+		tornado.ioloop.PeriodicCallback(lambda: reload_certificates(server), CERTIFICATES_CHECK_INTERVAL*1000).start()
+	if tornado.options.options.metrics_interval:
+		tornado.ioloop.PeriodicCallback(common.metrics.log_summaries, tornado.options.options.metrics_interval*1000).start()
+	if tornado.options.options.traffic_log_interval:
+		tornado.ioloop.PeriodicCallback(common.proxy.log_traffic, tornado.options.options.traffic_log_interval*1000).start()
+	if tornado.options.options.metrics_port:
+		# each worker has its own counters, and its own port
+		listen_metrics(server, tornado.options.options.metrics_port + (worker or 0))
 
 	io_loop.start()
+	if worker is not None:
+		# only losing the broker stops loop of worker; let it be restarted
+		sys.exit(1)
 
 if __name__ == '__main__':
 	main()
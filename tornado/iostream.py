@@ -33,6 +33,7 @@ import os
 import socket
 import sys
 import re
+import threading
 
 from tornado.concurrent import TracebackFuture
 from tornado import ioloop
@@ -60,6 +61,10 @@ _ERRNO_WOULDBLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
 if hasattr(errno, "WSAEWOULDBLOCK"):
     _ERRNO_WOULDBLOCK += (errno.WSAEWOULDBLOCK,)
 
+# Streams with nothing buffered read into this per-thread buffer and keep
+# only the bytes they got, so that idle streams hold no read buffer.
+_read_scratch = threading.local()
+
 # These errnos indicate that a connection has been abruptly terminated.
 # They should be caught and handled less noisily than other errors.
 _ERRNO_CONNRESET = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE,
@@ -74,6 +79,13 @@ _ERRNO_INPROGRESS = (errno.EINPROGRESS,)
 if hasattr(errno, "WSAEINPROGRESS"):
     _ERRNO_INPROGRESS += (errno.WSAEINPROGRESS,)
 
+# Upper bound of a single send.
+WRITE_BUFFER_CHUNK_SIZE = 128 * 1024
+
+# Upper bound of buffers passed to a single gather write (well below IOV_MAX).
+_MAX_WRITE_CHUNKS = 64
+
+
 #######################################################
 class StreamClosedError(IOError):
     """Exception raised by `IOStream` methods when the stream is closed.
@@ -141,22 +153,37 @@ class BaseIOStream(object):
                                    self.max_buffer_size // 2)
         self.max_write_buffer_size = max_write_buffer_size
         self.error = None
-        self._read_buffer = collections.deque()
+        # Data read, but not consumed yet, is _read_buffer_size bytes of
+        # _read_buffer starting at _read_buffer_pos; consumed data is
+        # dropped from the front once it outweighs the rest.  Space past
+        # the data is kept while data is buffered, as reads go straight
+        # into it, and the buffer is released once it is drained.
+        self._read_buffer = bytearray()
+        self._read_buffer_pos = 0
+        # Buffers queued by writes, kept as given; _write_buffer_pos is
+        # the offset of unsent data in the first one.
         self._write_buffer = collections.deque()
+        self._write_buffer_pos = 0
         self._read_buffer_size = 0
         self._write_buffer_size = 0
         self._write_buffer_frozen = False
+        self._write_buffer_frozen_size = 0
         self._read_delimiter = None
         self._read_regex = None
         self._read_max_bytes = None
         self._read_bytes = None
         self._read_partial = False
+        self._read_frame_size = None
         self._read_until_close = False
         self._read_callback = None
         self._read_future = None
         self._streaming_callback = None
         self._write_callback = None
-        self._write_future = None
+        # (position in the stream, future) for each pending write; a
+        # future is resolved once all data up to its position is sent.
+        self._write_futures = collections.deque()
+        self._total_write_index = 0
+        self._total_write_done_index = 0
         self._close_callback = None
         self._connect_callback = None
         self._connect_future = None
@@ -184,13 +211,22 @@ class BaseIOStream(object):
         """
         raise NotImplementedError()
 
-    def read_from_fd(self):
-        """Attempts to read from the underlying file.
+    def write_chunks_to_fd(self, chunks):
+        """Attempts to write a list of buffers to the underlying file.
 
-        Returns ``None`` if there was nothing to read (the socket
-        returned `~errno.EWOULDBLOCK` or equivalent), otherwise
-        returns the data.  When possible, should return no more than
-        ``self.read_chunk_size`` bytes at a time.
+        Returns the number of bytes written, as `write_to_fd`.  The
+        default implementation joins the buffers; subclasses may send
+        them without copying.
+        """
+        return self.write_to_fd(b"".join(chunks))
+
+    def read_from_fd(self, buf):
+        """Attempts to read from the underlying file into ``buf``.
+
+        ``buf`` is a writable `memoryview` of ``self.read_chunk_size``
+        bytes.  Returns ``None`` if there was nothing to read (the socket
+        returned `~errno.EWOULDBLOCK` or equivalent), otherwise returns
+        the number of bytes read into the beginning of ``buf``.
         """
         raise NotImplementedError()
 
@@ -284,6 +320,23 @@ class BaseIOStream(object):
         self._try_inline_read()
         return future
 
+    def read_frame(self, frame_size, callback=None):
+        """Asynchronously read a single frame of a length-prefixed protocol.
+
+        ``frame_size`` is called with the beginning of buffered data and
+        must return the total size of the frame starting there (header
+        included), or ``None`` if more data is needed to tell it.  Once
+        the size is known, this works like `read_bytes`; a frame that is
+        already buffered is returned without any further reads.
+
+        If a callback is given, it will be run with the frame as an
+        argument; if not, this method returns a `.Future`.
+        """
+        future = self._set_read_callback(callback)
+        self._read_frame_size = frame_size
+        self._try_inline_read()
+        return future
+
     def read_until_close(self, callback=None, streaming_callback=None):
         """Asynchronously reads all data from the socket until it is closed.
 
@@ -317,33 +370,42 @@ class BaseIOStream(object):
         callback is simply overwritten with this new callback.
 
         If no ``callback`` is given, this method returns a `.Future` that
-        resolves (with a result of ``None``) when the write has been
-        completed.  If `write` is called again before that `.Future` has
-        resolved, the previous future will be orphaned and will never resolve.
+        resolves (with a result of ``None``) when the given data has been
+        written, even if `write` is called again before that.
 
         .. versionchanged:: 4.0
             Now returns a `.Future` if no callback is given.
         """
-        assert isinstance(data, bytes_type)
+        return self.writev((data,), callback)
+
+    def writev(self, chunks, callback=None):
+        """Asynchronously write several buffers to this stream, as `write`.
+
+        The buffers (e.g. header and body of a message) are queued
+        together without being joined, and sent with a single gather
+        write where the underlying transport supports it.
+        """
         self._check_closed()
-        # We use bool(_write_buffer) as a proxy for write_buffer_size>0,
-        # so never put empty strings in the buffer.
-        if data:
+        for data in chunks:
+            assert isinstance(data, bytes_type)
+            # We use bool(_write_buffer) as a proxy for write_buffer_size>0,
+            # so never put empty strings in the buffer.
+            if not data:
+                continue
             if (self.max_write_buffer_size is not None and
                     self._write_buffer_size + len(data) > self.max_write_buffer_size):
                 raise StreamBufferFullError("Reached maximum read buffer size")
-            # Break up large contiguous strings before inserting them in the
-            # write buffer, so we don't have to recopy the entire thing
-            # as we slice off pieces to send to the socket.
-            WRITE_BUFFER_CHUNK_SIZE = 128 * 1024
-            for i in range(0, len(data), WRITE_BUFFER_CHUNK_SIZE):
-                self._write_buffer.append(data[i:i + WRITE_BUFFER_CHUNK_SIZE])
+            # Large strings are not split; pieces are sent as memoryview
+            # slices, so nothing is copied on partial sends.
+            self._write_buffer.append(data)
             self._write_buffer_size += len(data)
+            self._total_write_index += len(data)
         if callback is not None:
             self._write_callback = stack_context.wrap(callback)
             future = None
         else:
-            future = self._write_future = TracebackFuture()
+            future = TracebackFuture()
+            self._write_futures.append((self._total_write_index, future))
         if not self._connecting:
             self._handle_write()
             if self._write_buffer:
@@ -395,9 +457,8 @@ class BaseIOStream(object):
             if self._read_future is not None:
                 futures.append(self._read_future)
                 self._read_future = None
-            if self._write_future is not None:
-                futures.append(self._write_future)
-                self._write_future = None
+            futures.extend(future for _, future in self._write_futures)
+            self._write_futures.clear()
             if self._connect_future is not None:
                 futures.append(self._connect_future)
                 self._connect_future = None
@@ -433,6 +494,15 @@ class BaseIOStream(object):
         """Returns true if the stream has been closed."""
         return self._closed
 
+    def write_buffer_size(self):
+        """Returns the number of bytes written to the stream, but not yet
+        sent to the underlying file.
+
+        Useful for applying backpressure before reaching
+        ``max_write_buffer_size``.
+        """
+        return self._write_buffer_size
+
     def set_nodelay(self, value):
         """Sets the no-delay flag for this stream.
 
@@ -679,27 +749,43 @@ class BaseIOStream(object):
         to read (i.e. the read returns EWOULDBLOCK or equivalent).  On
         error closes the socket and raises an exception.
         """
-        try:
-            chunk = self.read_from_fd()
-        except (socket.error, IOError, OSError) as e:
-            # ssl.SSLError is a subclass of socket.error
-            if e.args[0] in _ERRNO_CONNRESET:
-                # Treat ECONNRESET as a connection close rather than
-                # an error to minimize log spam  (the exception will
-                # be available on self.error for apps that care).
-                self.close(exc_info=True)
-                return
-            self.close(exc_info=True)
-            raise
-        if chunk is None:
+        end = self._read_buffer_pos + self._read_buffer_size
+        if not self._read_buffer_size:
+            buf = getattr(_read_scratch, "buffer", None)
+            if buf is None or len(buf) < self.read_chunk_size:
+                buf = _read_scratch.buffer = bytearray(self.read_chunk_size)
+            end = 0
+        else:
+            buf = self._read_buffer
+            if len(buf) < end + self.read_chunk_size:
+                # Grown only while reads get ahead of consumers; the buffer
+                # must not be resized while the view below exists.
+                buf.extend(bytes(end + self.read_chunk_size - len(buf)))
+        with memoryview(buf) as view:
+            with view[end:end + self.read_chunk_size] as tail:
+                try:
+                    bytes_read = self.read_from_fd(tail)
+                except (socket.error, IOError, OSError) as e:
+                    # ssl.SSLError is a subclass of socket.error
+                    if e.args[0] in _ERRNO_CONNRESET:
+                        # Treat ECONNRESET as a connection close rather than
+                        # an error to minimize log spam  (the exception will
+                        # be available on self.error for apps that care).
+                        self.close(exc_info=True)
+                        return
+                    self.close(exc_info=True)
+                    raise
+                if bytes_read and buf is not self._read_buffer:
+                    self._read_buffer = bytearray(tail[:bytes_read])
+                    self._read_buffer_pos = 0
+        if bytes_read is None:
             return 0
-        self._read_buffer.append(chunk)
-        self._read_buffer_size += len(chunk)
+        self._read_buffer_size += bytes_read
         if self._read_buffer_size > self.max_buffer_size:
             gen_log.error("Reached maximum read buffer size")
             self.close()
             raise StreamBufferFullError("Reached maximum read buffer size")
-        return len(chunk)
+        return bytes_read
 
     def _run_streaming_callback(self):
         if self._streaming_callback is not None and self._read_buffer_size:
@@ -716,6 +802,7 @@ class BaseIOStream(object):
         as returned by _find_read_pos.
         """
         self._read_bytes = self._read_delimiter = self._read_regex = None
+        self._read_frame_size = None
         self._read_partial = False
         self._run_read_callback(pos, False)
 
@@ -732,39 +819,49 @@ class BaseIOStream(object):
             num_bytes = min(self._read_bytes, self._read_buffer_size)
             return num_bytes
         elif self._read_delimiter is not None:
-            # Multi-byte delimiters (e.g. '\r\n') may straddle two
-            # chunks in the read buffer, so we can't easily find them
-            # without collapsing the buffer.  However, since protocols
-            # using delimited reads (as opposed to reads of a known
-            # length) tend to be "line" oriented, the delimiter is likely
-            # to be in the first few chunks.  Merge the buffer gradually
-            # since large merges are relatively expensive and get undone in
-            # _consume().
-            if self._read_buffer:
-                while True:
-                    loc = self._read_buffer[0].find(self._read_delimiter)
-                    if loc != -1:
-                        delimiter_len = len(self._read_delimiter)
-                        self._check_max_bytes(self._read_delimiter,
-                                              loc + delimiter_len)
-                        return loc + delimiter_len
-                    if len(self._read_buffer) == 1:
-                        break
-                    _double_prefix(self._read_buffer)
+            # The buffer is contiguous, so delimiters straddling two reads
+            # are found in place, without merging anything.
+            if self._read_buffer_size:
+                loc = self._read_buffer.find(self._read_delimiter,
+                                             self._read_buffer_pos,
+                                             self._read_buffer_pos +
+                                             self._read_buffer_size)
+                if loc != -1:
+                    loc -= self._read_buffer_pos
+                    delimiter_len = len(self._read_delimiter)
+                    self._check_max_bytes(self._read_delimiter,
+                                          loc + delimiter_len)
+                    return loc + delimiter_len
                 self._check_max_bytes(self._read_delimiter,
-                                      len(self._read_buffer[0]))
+                                      self._read_buffer_size)
+        elif self._read_frame_size is not None:
+            if self._read_buffer_size:
+                # The view must be released before the buffer may grow.
+                view = memoryview(self._read_buffer)[
+                    self._read_buffer_pos:
+                    self._read_buffer_pos + self._read_buffer_size]
+                try:
+                    size = self._read_frame_size(view)
+                finally:
+                    view.release()
+                if size is not None:
+                    if size <= self._read_buffer_size:
+                        return size
+                    # Wait for the rest of the frame like read_bytes.
+                    self._read_bytes = size
+                    self._read_frame_size = None
         elif self._read_regex is not None:
-            if self._read_buffer:
-                while True:
-                    m = self._read_regex.search(self._read_buffer[0])
-                    if m is not None:
-                        self._check_max_bytes(self._read_regex, m.end())
-                        return m.end()
-                    if len(self._read_buffer) == 1:
-                        break
-                    _double_prefix(self._read_buffer)
+            if self._read_buffer_size:
+                m = self._read_regex.search(self._read_buffer,
+                                            self._read_buffer_pos,
+                                            self._read_buffer_pos +
+                                            self._read_buffer_size)
+                if m is not None:
+                    loc = m.end() - self._read_buffer_pos
+                    self._check_max_bytes(self._read_regex, loc)
+                    return loc
                 self._check_max_bytes(self._read_regex,
-                                      len(self._read_buffer[0]))
+                                      self._read_buffer_size)
         return None
 
     def _check_max_bytes(self, delimiter, size):
@@ -774,35 +871,68 @@ class BaseIOStream(object):
                 "delimiter %r not found within %d bytes" % (
                     delimiter, self._read_max_bytes))
 
+    def _write_buffer_views(self, size):
+        """Returns `memoryview` slices covering (up to) the first
+        ``size`` bytes of the write buffer, without copying them.
+        """
+        views = []
+        pos = self._write_buffer_pos
+        for chunk in self._write_buffer:
+            view = memoryview(chunk)[pos:pos + size]
+            pos = 0
+            views.append(view)
+            size -= len(view)
+            if not size or len(views) >= _MAX_WRITE_CHUNKS:
+                break
+        return views
+
+    def _consume_write_buffer(self, size):
+        """Removes the first ``size`` bytes from the write buffer."""
+        while size:
+            remaining = len(self._write_buffer[0]) - self._write_buffer_pos
+            if remaining > size:
+                self._write_buffer_pos += size
+                return
+            self._write_buffer.popleft()
+            self._write_buffer_pos = 0
+            size -= remaining
+
     def _handle_write(self):
         while self._write_buffer:
             try:
-                if not self._write_buffer_frozen:
+                if self._write_buffer_frozen:
+                    # With OpenSSL, if we couldn't write the entire buffer,
+                    # the very same data must be used on the next call to
+                    # send.  Therefore we retry with the same bytes after
+                    # an incomplete send.  (Python sets
+                    # SSL_MODE_ACCEPT_MOVING_WRITE_BUFFER, so the data
+                    # may be gathered into a different buffer.)
+                    size = self._write_buffer_frozen_size
+                else:
                     # On windows, socket.send blows up if given a
                     # write buffer that's too large, instead of just
                     # returning the number of bytes it was able to
                     # process.  Therefore we must not call socket.send
                     # with more than 128KB at a time.
-                    _merge_prefix(self._write_buffer, 128 * 1024)
-                num_bytes = self.write_to_fd(self._write_buffer[0])
+                    size = WRITE_BUFFER_CHUNK_SIZE
+                views = self._write_buffer_views(size)
+                size = sum(len(view) for view in views)
+                if len(views) == 1:
+                    num_bytes = self.write_to_fd(views[0])
+                else:
+                    num_bytes = self.write_chunks_to_fd(views)
                 if num_bytes == 0:
-                    # With OpenSSL, if we couldn't write the entire buffer,
-                    # the very same string object must be used on the
-                    # next call to send.  Therefore we suppress
-                    # merging the write buffer after an incomplete send.
-                    # A cleaner solution would be to set
-                    # SSL_MODE_ACCEPT_MOVING_WRITE_BUFFER, but this is
-                    # not yet accessible from python
-                    # (http://bugs.python.org/issue8240)
                     self._write_buffer_frozen = True
+                    self._write_buffer_frozen_size = size
                     break
                 self._write_buffer_frozen = False
-                _merge_prefix(self._write_buffer, num_bytes)
-                self._write_buffer.popleft()
+                self._consume_write_buffer(num_bytes)
                 self._write_buffer_size -= num_bytes
+                self._total_write_done_index += num_bytes
             except (socket.error, IOError, OSError) as e:
                 if e.args[0] in _ERRNO_WOULDBLOCK:
                     self._write_buffer_frozen = True
+                    self._write_buffer_frozen_size = size
                     break
                 else:
                     if e.args[0] not in _ERRNO_CONNRESET:
@@ -813,22 +943,40 @@ class BaseIOStream(object):
                                         self.fileno(), e)
                     self.close(exc_info=True)
                     return
+        while self._write_futures:
+            index, future = self._write_futures[0]
+            if index > self._total_write_done_index:
+                break
+            self._write_futures.popleft()
+            future.set_result(None)
         if not self._write_buffer:
             if self._write_callback:
                 callback = self._write_callback
                 self._write_callback = None
                 self._run_callback(callback)
-            if self._write_future:
-                future = self._write_future
-                self._write_future = None
-                future.set_result(None)
 
     def _consume(self, loc):
         if loc == 0:
             return b""
-        _merge_prefix(self._read_buffer, loc)
-        self._read_buffer_size -= loc
-        return self._read_buffer.popleft()
+        assert loc <= self._read_buffer_size
+        pos = self._read_buffer_pos
+        size = self._read_buffer_size - loc
+        with memoryview(self._read_buffer) as view:
+            data = view[pos:pos + loc].tobytes()
+            pos += loc
+            # Compact only once the consumed prefix outgrows the rest, so
+            # each byte is moved at most once on average.  The rest does
+            # not overlap its new place, and the buffer keeps its size,
+            # which is allowed even while a read into it is in progress.
+            if pos > size:
+                view[:size] = view[pos:pos + size]
+                pos = 0
+        if size == 0:
+            self._read_buffer = bytearray()
+            pos = 0
+        self._read_buffer_pos = pos
+        self._read_buffer_size = size
+        return data
 
     def _check_closed(self):
         if self.closed():
@@ -942,22 +1090,27 @@ class IOStream(BaseIOStream):
                                        socket.SO_ERROR)
         return socket.error(errno, os.strerror(errno))
 
-    def read_from_fd(self):
+    def read_from_fd(self, buf):
         try:
-            chunk = self.socket.recv(self.read_chunk_size)
+            bytes_read = self.socket.recv_into(buf)
         except socket.error as e:
             if e.args[0] in _ERRNO_WOULDBLOCK:
                 return None
             else:
                 raise
-        if not chunk:
+        if not bytes_read:
             self.close()
             return None
-        return chunk
+        return bytes_read
 
     def write_to_fd(self, data):
         return self.socket.send(data)
 
+    def write_chunks_to_fd(self, chunks):
+        if not hasattr(self.socket, "sendmsg"):
+            return super(IOStream, self).write_chunks_to_fd(chunks)
+        return self.socket.sendmsg(chunks)
+
     def connect(self, address, callback=None, server_hostname=None):
         """Connects the socket to a remote address without blocking.
 
@@ -1047,10 +1200,10 @@ class IOStream(BaseIOStream):
         .. versionadded:: 4.0
         """
         if (self._read_callback or self._read_future or
-                self._write_callback or self._write_future or
+                self._write_callback or self._write_futures or
                 self._connect_callback or self._connect_future or
                 self._pending_callbacks or self._closed or
-                self._read_buffer or self._write_buffer):
+                self._read_buffer_size or self._write_buffer):
             raise ValueError("IOStream is not idle; cannot convert to SSL")
         if ssl_options is None:
             ssl_options = {}
@@ -1117,6 +1270,44 @@ class IOStream(BaseIOStream):
                 if e.errno not in (errno.EINVAL, errno.ECONNRESET):
                     raise
 
+    def detach(self):
+        """Takes the socket away from this stream.
+
+        Returns a tuple ``(socket, data)``, where ``data`` are bytes
+        already read from the socket, but not consumed by any read.
+        The stream must have no pending reads or writes; after this
+        call it is closed, but the socket is left open and is owned
+        by the caller.
+        """
+        if self.reading() or self.writing():
+            raise ValueError("Cannot detach a stream with pending operations")
+        if self.closed():
+            raise StreamClosedError()
+        if self._state is not None:
+            self.io_loop.remove_handler(self.fileno())
+            self._state = None
+        data = self._consume(self._read_buffer_size)
+        self._read_buffer = bytearray()
+        self._read_buffer_pos = 0
+        sock = self.socket
+        self.socket = None
+        self._closed = True
+        self._maybe_run_close_callback()
+        return sock, data
+
+    def unread(self, data):
+        """Puts ``data`` in front of bytes not consumed from this stream yet.
+
+        Counterpart of `detach`: data returned by it can be given back to
+        a new stream of the same socket, so that reads see no gap.  The
+        stream must have no pending reads.
+        """
+        if self.reading():
+            raise ValueError("Cannot unread to a stream with pending reads")
+        pos = self._read_buffer_pos
+        self._read_buffer[pos:pos] = data
+        self._read_buffer_size += len(data)
+
 
 class SSLIOStream(IOStream):
     """A utility class to write to and read from a non-blocking SSL socket.
@@ -1141,6 +1332,9 @@ class SSLIOStream(IOStream):
         self._handshake_writing = False
         self._ssl_connect_callback = None
         self._server_hostname = None
+        # SSL sockets cannot gather writes, so chunks are copied
+        # into this buffer, which is reused for all writes.
+        self._write_scratch = bytearray()
 
         # If the socket is already connected, attempt to start the handshake.
         try:
@@ -1274,7 +1468,24 @@ class SSLIOStream(IOStream):
                                       do_handshake_on_connect=False)
         self._add_io_state(old_state)
 
-    def read_from_fd(self):
+    def write_to_fd(self, data):
+        try:
+            return self.socket.send(data)
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                # Since Python 3.5, SSLSocket.send raises WANT_WRITE
+                # instead of returning 0 if the socket is not writeable.
+                return 0
+            raise
+
+    def write_chunks_to_fd(self, chunks):
+        scratch = self._write_scratch
+        del scratch[:]
+        for chunk in chunks:
+            scratch += chunk
+        return self.write_to_fd(scratch)
+
+    def read_from_fd(self, buf):
         if self._ssl_accepting:
             # If the handshake hasn't finished yet, there can't be anything
             # to read (attempting to read may or may not raise an exception
@@ -1286,7 +1497,7 @@ class SSLIOStream(IOStream):
             # The recv() method blocks (at least in python 2.6) if it is
             # called when there is nothing to read, so we have to use
             # read() instead.
-            chunk = self.socket.read(self.read_chunk_size)
+            bytes_read = self.socket.read(len(buf), buf)
         except ssl.SSLError as e:
             # SSLError is a subclass of socket.error, so this except
             # block must come first.
@@ -1299,10 +1510,10 @@ class SSLIOStream(IOStream):
                 return None
             else:
                 raise
-        if not chunk:
+        if not bytes_read:
             self.close()
             return None
-        return chunk
+        return bytes_read
 
 
 class PipeIOStream(BaseIOStream):
@@ -1327,9 +1538,9 @@ class PipeIOStream(BaseIOStream):
     def write_to_fd(self, data):
         return os.write(self.fd, data)
 
-    def read_from_fd(self):
+    def read_from_fd(self, buf):
         try:
-            chunk = os.read(self.fd, self.read_chunk_size)
+            bytes_read = os.readv(self.fd, [buf])
         except (IOError, OSError) as e:
             if errno_from_exception(e) in _ERRNO_WOULDBLOCK:
                 return None
@@ -1340,57 +1551,10 @@ class PipeIOStream(BaseIOStream):
                 return None
             else:
                 raise
-        if not chunk:
+        if not bytes_read:
             self.close()
             return None
-        return chunk
-
-
-def _double_prefix(deque):
-    """Grow by doubling, but don't split the second chunk just because the
-    first one is small.
-    """
-    new_len = max(len(deque[0]) * 2,
-                  (len(deque[0]) + len(deque[1])))
-    _merge_prefix(deque, new_len)
-
-
-def _merge_prefix(deque, size):
-    """Replace the first entries in a deque of strings with a single
-    string of up to size bytes.
-
-    >>> d = collections.deque(['abc', 'de', 'fghi', 'j'])
-    >>> _merge_prefix(d, 5); print(d)
-    deque(['abcde', 'fghi', 'j'])
-
-    Strings will be split as necessary to reach the desired size.
-    >>> _merge_prefix(d, 7); print(d)
-    deque(['abcdefg', 'hi', 'j'])
-
-    >>> _merge_prefix(d, 3); print(d)
-    deque(['abc', 'defg', 'hi', 'j'])
-
-    >>> _merge_prefix(d, 100); print(d)
-    deque(['abcdefghij'])
-    """
-    if len(deque) == 1 and len(deque[0]) <= size:
-        return
-    prefix = []
-    remaining = size
-    while deque and remaining > 0:
-        chunk = deque.popleft()
-        if len(chunk) > remaining:
-            deque.appendleft(chunk[remaining:])
-            chunk = chunk[:remaining]
-        prefix.append(chunk)
-        remaining -= len(chunk)
-    # This data structure normally just contains byte strings, but
-    # the unittest gets messy if it doesn't use the default str() type,
-    # so do the merge based on the type of data that's actually present.
-    if prefix:
-        deque.appendleft(type(prefix[0])().join(prefix))
-    if not deque:
-        deque.appendleft(b"")
+        return bytes_read
 
 
 def doctests():
@@ -146,7 +146,8 @@ class TCPServer(object):
         """Singular version of `add_sockets`.  Takes a single socket object."""
         self.add_sockets([socket])
 
-    def bind(self, port, address=None, family=socket.AF_UNSPEC, backlog=128):
+    def bind(self, port, address=None, family=socket.AF_UNSPEC, backlog=128,
+             reuse_port=False):
         """Binds this server to the given port on the given address.
 
         To start the server, call `start`. If you want to run this server
@@ -163,11 +164,14 @@ class TCPServer(object):
         The ``backlog`` argument has the same meaning as for
         `socket.listen <socket.socket.listen>`.
 
+        The ``reuse_port`` argument has the same meaning as for
+        `.bind_sockets`.
+
         This method may be called multiple times prior to `start` to listen
         on multiple ports or interfaces.
         """
         sockets = bind_sockets(port, address=address, family=family,
-                               backlog=backlog)
+                               backlog=backlog, reuse_port=reuse_port)
         if self._started:
             self.add_sockets(sockets)
         else:
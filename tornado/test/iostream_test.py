@@ -516,9 +516,9 @@ class TestIOStreamMixin(object):
             client.write(b'a')
             # Stub out read_from_fd to make it fail.
 
-            def fake_read_from_fd():
+            def fake_read_from_fd(buf):
                 os.close(server.socket.fileno())
-                server.__class__.read_from_fd(server)
+                server.__class__.read_from_fd(server, buf)
             server.read_from_fd = fake_read_from_fd
             # This log message is from _handle_read (not read_from_fd).
             with ExpectLog(gen_log, "error on read"):
@@ -574,6 +574,61 @@ class TestIOStreamMixin(object):
             server.close()
             client.close()
 
+    def test_read_frame(self):
+        server, client = self.make_iostream_pair()
+
+        def frame_size(data):
+            # One byte of header holding the length of the body.
+            return 1 + data[0] if data else None
+        try:
+            # Frames already buffered are returned one at a time.
+            server.write(b"\x03abc\x00\x02de")
+            client.read_frame(frame_size, self.stop)
+            self.assertEqual(self.wait(), b"\x03abc")
+            client.read_frame(frame_size, self.stop)
+            self.assertEqual(self.wait(), b"\x00")
+            client.read_frame(frame_size, self.stop)
+            self.assertEqual(self.wait(), b"\x02de")
+
+            # Frame arriving in pieces.
+            client.read_frame(frame_size, self.stop)
+            server.write(b"\x05he")
+            self.io_loop.add_timeout(self.io_loop.time() + 0.01, self.stop)
+            self.wait()
+            server.write(b"llo")
+            self.assertEqual(self.wait(), b"\x05hello")
+        finally:
+            server.close()
+            client.close()
+
+    def test_writev(self):
+        server, client = self.make_iostream_pair()
+        try:
+            # Enough data to need several sends, including partial ones.
+            chunks = [b"header", b"A" * 1024 * 1024, b"", b"trailer"]
+            expected = b"".join(chunks)
+            server.writev(chunks)
+            client.read_bytes(len(expected), self.stop)
+            self.assertEqual(self.wait(), expected)
+        finally:
+            server.close()
+            client.close()
+
+    def test_write_futures(self):
+        server, client = self.make_iostream_pair()
+        try:
+            # Every future resolves, even if written over before that.
+            futures = [server.write(b"A" * 1024 * 1024) for i in range(3)]
+            client.read_bytes(3 * 1024 * 1024, self.stop)
+            self.wait()
+            self.io_loop.add_future(futures[-1], self.stop)
+            self.wait()
+            self.assertTrue(all(f.done() for f in futures))
+            self.assertEqual(server.write_buffer_size(), 0)
+        finally:
+            server.close()
+            client.close()
+
     def test_read_until_max_bytes(self):
         server, client = self.make_iostream_pair()
         client.set_close_callback(lambda: self.stop("closed"))
@@ -742,6 +797,59 @@ class TestIOStream(TestIOStreamMixin, AsyncTestCase):
     def _make_client_iostream(self, connection, **kwargs):
         return IOStream(connection, **kwargs)
 
+    def test_detach(self):
+        server, client = self.make_iostream_pair()
+        try:
+            server.write(b"abcdef")
+            client.read_bytes(2, self.stop)
+            self.assertEqual(self.wait(), b"ab")
+            # Wait until the rest is buffered by the stream.
+            while client._read_buffer_size < 4:
+                client._read_to_buffer()
+            sock, data = client.detach()
+            self.assertTrue(client.closed())
+            self.assertEqual(data, b"cdef")
+            server.write(b"gh", self.stop)
+            self.wait()
+            sock.setblocking(True)
+            self.assertEqual(sock.recv(2), b"gh")
+            sock.close()
+        finally:
+            server.close()
+            client.close()
+
+    def test_unread(self):
+        server, client = self.make_iostream_pair()
+        try:
+            server.write(b"cdef")
+            client.unread(b"ab")
+            client.read_bytes(6, self.stop)
+            self.assertEqual(self.wait(), b"abcdef")
+        finally:
+            server.close()
+            client.close()
+
+    def test_drained_read_buffer_released(self):
+        server, client = self.make_iostream_pair()
+        try:
+            server.write(b"abcdef")
+            client.read_bytes(2, self.stop)
+            self.assertEqual(self.wait(), b"ab")
+            while client._read_buffer_size < 4:
+                client._read_to_buffer()
+            # Partly consumed data keeps its buffer, and reads append to it.
+            server.write(b"gh")
+            client.read_bytes(6, self.stop)
+            self.assertEqual(self.wait(), b"cdefgh")
+            self.assertEqual(len(client._read_buffer), 0)
+            server.write(b"ij")
+            client.read_bytes(2, self.stop)
+            self.assertEqual(self.wait(), b"ij")
+            self.assertEqual(len(client._read_buffer), 0)
+        finally:
+            server.close()
+            client.close()
+
 
 class TestIOStreamSSL(TestIOStreamMixin, AsyncTestCase):
     def _make_server_iostream(self, connection, **kwargs):